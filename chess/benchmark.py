@@ -0,0 +1,341 @@
+"""
+Benchmarks for the custom sunfish engine.
+
+Run from the project root, e.g.::
+
+    python -m chess.benchmark perft
+    python -m chess.benchmark perft --fen "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -" --depth 5
+    python -m chess.benchmark search --json results.json --baseline baseline.json
+    python -m chess.benchmark search --without lmr futility
+    python -m chess.benchmark aspiration --depth 6
+    python -m chess.benchmark smp --workers 1 2 4 8 --secs 5
+"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+import time
+import chess.sunfish_custom as sunfish
+from chess.bitboard import initial_position, from_fen
+
+# Games played into the opening and middlegame, as moves from the starting position
+OPENINGS = [
+    '',
+    'e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6',
+    'd2d4 d7d5 c2c4 e7e6 b1c3 g8f6 c1g5 f8e7 e2e3 e8g8',
+    'e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6',
+]
+
+# Search techniques which the search benchmark can switch off, with their sunfish constants
+SWITCHES = {
+    'see': 'SEE_PRUNING',
+    'lmr': 'LMR',
+    'futility': 'FUTILITY',
+    'reverse-futility': 'REVERSE_FUTILITY',
+    'stack': 'STACK_SEARCH',
+    'aspiration': 'ASPIRATION',
+    'mate': 'MATE_SEARCH',
+}
+
+# Perft positions with their leaf counts from depth 1. Sunfish only promotes to queens, so only
+# depths without promotions are listed.
+PERFT_POSITIONS = [
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+     (20, 400, 8902, 197281, 4865609)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     (48, 2039, 97862)),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     (46, 2079, 89890, 3894594)),
+    ('pawn ending', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     (14, 191, 2812, 43238, 674624)),
+    ('rook ending', '4k3/8/8/8/8/8/8/R3K2R w KQ - 0 1',
+     (26, 112, 3189, 17945, 532933)),
+    ('en passant', '8/5k2/8/2Pp4/8/8/8/4K3 w - d6 0 1',
+     (7, 61, 443, 3318)),
+    ('black to move', 'r3k2r/8/8/8/3pP3/8/8/R3K2R b KQkq e3 0 1',
+     (28, 648, 16046, 378853)),
+]
+
+# Search positions with the best moves expected (none for the positional ones, which are only
+# timed). The tactical ones are the first of the Win At Chess suite.
+SEARCH_POSITIONS = [
+    ('wac001', '2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - 0 1', ('g3g6',)),
+    ('wac002', '8/7p/5k2/5p2/p1p2P2/Pr1pPK2/1P1R3P/6R1 b - - 0 1', ('b3b2',)),
+    ('wac003', '5rk1/1ppb3p/p1pb4/6q1/3P1p1r/2P1R2P/PP1BQ1P1/5RKN w - - 0 1', ('e3g3',)),
+    ('wac004', 'r1bq2rk/pp3pbp/2p1p1pQ/7P/3P4/2PB1N2/PP3PPR/2KR4 w - - 0 1', ('h6h7',)),
+    ('wac005', '5k2/6pp/p1qN4/1p1p4/3P4/2PKP2Q/PP3r2/3R4 b - - 0 1', ('c6c4',)),
+    ('wac006', '7k/p7/1R5K/6r1/6p1/6P1/8/8 w - - 0 1', ('b6b7',)),
+    ('wac007', 'rnbqkb1r/pppp1ppp/8/4P3/6n1/7P/PPPNPPP1/R1BQKBNR b KQkq - 0 1', ('g4e3',)),
+    ('wac008', 'r4q1k/p2bR1rp/2p2Q1N/5p2/5p2/2P5/PP3PPP/R5K1 w - - 0 1', ('e7f7',)),
+    ('wac009', '3q1rk1/p4pp1/2pb3p/3p4/6Pr/1PNQ4/P1PB1PP1/4RRK1 b - - 0 1', ('d6h2',)),
+    ('wac010', '2br2k1/2q3rn/p2NppQ1/2p1P3/Pp5R/4P3/1P3PPP/3R2K1 w - - 0 1', ('h4h7',)),
+    ('mate in 2', 'r2qkb1r/pp2nppp/3p4/2pNN1B1/2BnP3/3P4/PPP2PPP/R2bK2R w KQkq - 1 1',
+     ('d5f6',)),
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', ()),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', ()),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     ()),
+    ('pawn ending', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', ()),
+]
+
+
+def render_move(pos, move):
+    """The move in coordinate notation (e.g. 'e2e4') as seen by white."""
+    i, j = move
+    if pos.color:  # The board is rotated when black is to move
+        i, j = 119 - i, 119 - j
+    return sunfish.render(i) + sunfish.render(j)
+
+
+def play(moves, pos=None):
+    """Plays a space separated list of moves like 'e2e4 e7e5' from pos (by default the starting
+    position) and returns the position reached."""
+    return sunfish.replay(pos or initial_position(), moves.split())
+
+
+def perft(pos, depth, counters):
+    """Counts the positions reached from pos by depth legal moves. Sunfish lets kings be
+    captured, so a move is only legal if the reply can't capture the king (or the square the king
+    passed while castling). counters tallies the moves generated and positions made."""
+    moves = list(pos.gen_moves())
+    counters['generated'] += len(moves)
+    if any(pos.value(move) >= sunfish.MATE_LOWER for move in moves):
+        return 0  # The move leading here was illegal
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in moves:
+        counters['made'] += 1
+        nodes += perft(pos.move(move), depth - 1, counters)
+    return nodes
+
+
+def run_perft(positions, max_depth, mailbox):
+    """Runs perft on each (name, fen, counts) to the depth of its last known count, or
+    max_depth, and prints the speed of move generation and of making moves. Returns whether all
+    counts matched."""
+    print("position        depth     leaves  expected  generated/s  made/s")
+    passed = True
+    for name, fen, counts in positions:
+        pos = from_fen(fen)
+        if mailbox:
+            pos = pos.to_position()
+        for depth in range(1, min(max_depth, len(counts) or max_depth) + 1):
+            counters = {'generated': 0, 'made': 0}
+            start = time.time()
+            nodes = perft(pos, depth, counters)
+            elapsed = max(time.time() - start, 1e-6)
+            expected = counts[depth - 1] if depth <= len(counts) else None
+            if expected is not None and nodes != expected:
+                passed = False
+            print("{:14s}  {:5d}  {:9d}  {:>8s}  {:11.0f}  {:6.0f}  {}".format(
+                name, depth, nodes, str(expected or '-'), counters['generated'] / elapsed,
+                counters['made'] / elapsed,
+                'FAIL' if expected is not None and nodes != expected else ''))
+    print("All counts match" if passed else "Some counts DON'T match")
+    return passed
+
+
+def run_search(positions, depth, secs, table_mb, mailbox=False):
+    """Searches each (name, fen, best moves) twice with an empty table: to depth, which gives
+    the nodes, time to depth and table hit rate, and for secs, which gives the depth reached in
+    the time budget. The move found at depth is checked against the best moves. With mailbox
+    the searches run on Position rather than BitboardPosition. Returns the results as a dict
+    ready for JSON."""
+    results = {}
+    print("position       nodes  in QS  time (s)  nodes/s  hit rate  1st cut  depth in {}s  move"
+          "   best".format(secs))
+    for name, fen, best in positions:
+        pos = from_fen(fen)
+        # The move is rendered from pos, which knows the side to move
+        searched = pos.to_position() if mailbox else pos
+        searcher = sunfish.Searcher(table_mb)
+        start = time.time()
+        move, score = searcher.search(searched, depth=depth)
+        elapsed = max(time.time() - start, 1e-6)
+        stats = searcher.tp.stats()
+        result = {
+            'nodes': searcher.nodes,
+            'qs_nodes': searcher.qs_nodes,
+            'time_to_depth': elapsed,
+            'nps': searcher.nodes / elapsed,
+            'tt_hit_rate': stats['hits'] / float(max(stats['probes'], 1)),
+            'cutoff_rate': searcher.cutoff_rate(),
+            'move': render_move(pos, move),
+            'score': score,
+            'correct': render_move(pos, move) in best if best else None,
+            # Answered by Searcher.mate(), whose depth is that of the mate and which makes no
+            # cutoffs, so it is left out of the means of those
+            'mate': searcher.last_search['source'] == 'mate',
+        }
+        searcher = sunfish.Searcher(table_mb)
+        start = time.time()
+        searcher.search(searched, secs=secs, deadline=start + secs)
+        result['budget_depth'] = searcher.depth
+        result['budget_nps'] = searcher.nodes / max(time.time() - start, 1e-6)
+        result['budget_mate'] = searcher.last_search['source'] == 'mate'
+        results[name] = result
+        print("{:12s}  {:7d}  {:5.2f}  {:8.2f}  {:7.0f}  {:8.2f}  {:7.2f}  {:11d}  {:5s}  {}{}"
+              .format(name, result['nodes'], result['qs_nodes'] / float(result['nodes']), elapsed,
+                      result['nps'], result['tt_hit_rate'], result['cutoff_rate'],
+                      result['budget_depth'], result['move'], ' '.join(best) or '-',
+                      '  (mate search)' if result['mate'] or result['budget_mate'] else ''))
+    tactical = [r for r in results.values() if r['correct'] is not None]
+    searches = [r for r in results.values() if not r['mate']]
+    budgeted = [r for r in results.values() if not r['budget_mate']]
+    summary = {
+        'nodes': sum(r['nodes'] for r in results.values()),
+        'qs_nodes': sum(r['qs_nodes'] for r in results.values()),
+        'time_to_depth': sum(r['time_to_depth'] for r in results.values()),
+        'budget_depth': sum(r['budget_depth'] for r in budgeted) / float(max(len(budgeted), 1)),
+        'tt_hit_rate': sum(r['tt_hit_rate'] for r in results.values()) / float(len(results)),
+        'cutoff_rate': sum(r['cutoff_rate'] for r in searches) / float(max(len(searches), 1)),
+        'solved': sum(1 for r in tactical if r['correct']),
+        'tactical': len(tactical),
+        'mates': sum(1 for r in results.values() if r['mate'] or r['budget_mate']),
+    }
+    summary['nps'] = summary['nodes'] / summary['time_to_depth']
+    print("Total {nodes} nodes ({qs_nodes} in QS) in {time_to_depth:.2f}s ({nps:.0f} nodes/s), "
+          "{cutoff_rate:.2f} of cutoffs on the first move, {budget_depth:.2f} mean depth in "
+          "budget, {solved}/{tactical} solved, {mates} answered by the mate search"
+          .format(**summary))
+    return {'depth': depth, 'secs': secs, 'table_mb': table_mb, 'mailbox': mailbox,
+            'positions': results, 'summary': summary}
+
+
+def compare(results, baseline):
+    """Prints the change of each result from a baseline made with run_search. Returns the
+    positions which were solved in the baseline but aren't any more."""
+    if (results['depth'], results['secs']) != (baseline['depth'], baseline['secs']):
+        print("Warning: the baseline was searched to depth {depth} with {secs}s".format(
+            **baseline))
+    change = lambda new, old: 100.0 * (new - old) / old if old else 0.0
+    print("position      nodes  time to depth  nodes/s  depth in budget  solved")
+    regressions = []
+    for name, result in sorted(results['positions'].items()):
+        old = baseline['positions'].get(name)
+        if old is None:
+            continue
+        if old['correct'] and not result['correct']:
+            regressions.append(name)
+        print("{:12s}  {:+5.0f}%  {:+12.0f}%  {:+6.0f}%  {:+15d}  {}".format(
+            name, change(result['nodes'], old['nodes']),
+            change(result['time_to_depth'], old['time_to_depth']),
+            change(result['nps'], old['nps']), result['budget_depth'] - old['budget_depth'],
+            {(True, False): 'LOST', (False, True): 'new'}.get(
+                (bool(old['correct']), bool(result['correct'])), '')))
+    new, old = results['summary'], baseline['summary']
+    print("Total: nodes {:+.0f}%, nodes/s {:+.0f}%, depth in budget {:+.2f}, solved {} -> {}"
+          .format(change(new['nodes'], old['nodes']), change(new['nps'], old['nps']),
+                  new['budget_depth'] - old['budget_depth'], old['solved'], new['solved']))
+    if 'qs_nodes' in old:
+        print("       QS nodes {:+.0f}%".format(change(new['qs_nodes'], old['qs_nodes'])))
+    return regressions
+
+
+def aspiration(positions, depth, table_mb):
+    """Searches each position to depth with and without aspiration windows, and prints the
+    bound() calls made at the root by each iteration, summed over the positions."""
+    calls = {}
+    totals = {}
+    for enabled in (False, True):
+        sunfish.ASPIRATION = enabled
+        nodes = elapsed = 0
+        for name, fen, _ in positions:
+            searcher = sunfish.Searcher(table_mb)
+            start = time.time()
+            searcher.search(from_fen(fen), depth=depth)
+            elapsed += time.time() - start
+            nodes += searcher.nodes
+            for d, n in searcher.bound_calls.items():
+                calls[d, enabled] = calls.get((d, enabled), 0) + n
+        totals[enabled] = nodes, elapsed
+    print("depth  full window  aspiration  saved")
+    for d in range(1, depth + 1):
+        print("{:5d}  {:11d}  {:10d}  {:5d}".format(
+            d, calls[d, False], calls[d, True], calls[d, False] - calls[d, True]))
+    for enabled in (False, True):
+        print("{}: {} nodes in {:.2f}s".format('Aspiration' if enabled else 'Full window',
+                                             *totals[enabled]))
+
+
+def smp(workers, secs, table_mb):
+    """Searches each opening for secs with each number of workers and prints the depth reached
+    and the speed of the search."""
+    print("workers  depth  depth/s   nodes/s  speedup")
+    baseline = None
+    for n in workers:
+        searcher = sunfish.ParallelSearcher(n, table_mb) if n > 1 else sunfish.Searcher(table_mb)
+        depth = nodes = elapsed = 0
+        for moves in OPENINGS:
+            pos = play(moves)
+            searcher.tp.new_search()
+            start = time.time()
+            searcher.search(pos, secs)
+            elapsed += time.time() - start
+            depth += searcher.depth
+            nodes += searcher.nodes
+        if n > 1:
+            searcher.close()
+        depth /= float(len(OPENINGS))
+        nps = nodes / elapsed
+        baseline = baseline or nps
+        print("{:7d}  {:5.1f}  {:7.2f}  {:8.0f}  {:7.2f}".format(
+            n, depth, depth / (elapsed / len(OPENINGS)), nps, nps / baseline))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sunfish benchmarks")
+    commands = parser.add_subparsers(dest='command')
+    smp_parser = commands.add_parser('smp', help="scaling of the parallel search with workers")
+    smp_parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    smp_parser.add_argument('-s', '--secs', type=float, default=5)
+    smp_parser.add_argument('-m', '--table-mb', type=int, default=sunfish.TABLE_MB)
+    perft_parser = commands.add_parser('perft', help="count and time move generation")
+    perft_parser.add_argument('-f', '--fen', help="position to count, instead of the standard "
+                                                   "positions")
+    perft_parser.add_argument('-d', '--depth', type=int, default=3)
+    perft_parser.add_argument('--mailbox', action='store_true',
+                              help="use the mailbox Position instead of the BitboardPosition")
+    aspiration_parser = commands.add_parser('aspiration', help="bound() calls saved by "
+                                                              "aspiration windows")
+    aspiration_parser.add_argument('-d', '--depth', type=int, default=6)
+    aspiration_parser.add_argument('-m', '--table-mb', type=int, default=sunfish.TABLE_MB)
+    search_parser = commands.add_parser('search', help="time the search on test positions")
+    search_parser.add_argument('-d', '--depth', type=int, default=5)
+    search_parser.add_argument('-s', '--secs', type=float, default=2,
+                               help="time budget, as given to each move during a game")
+    search_parser.add_argument('-m', '--table-mb', type=int, default=sunfish.TABLE_MB)
+    search_parser.add_argument('-j', '--json', help="file to write the results to")
+    search_parser.add_argument('-b', '--baseline', help="results file to compare against")
+    search_parser.add_argument('-w', '--without', nargs='+', default=[],
+                               choices=sorted(SWITCHES), help="search techniques to switch off")
+    search_parser.add_argument('--mailbox', action='store_true',
+                               help="use the mailbox Position instead of the BitboardPosition")
+    args = parser.parse_args()
+
+    if args.command == 'smp':
+        smp(args.workers, args.secs, args.table_mb)
+    elif args.command == 'perft':
+        positions = [('fen', args.fen, ())] if args.fen else PERFT_POSITIONS
+        if not run_perft(positions, args.depth, args.mailbox):
+            sys.exit(1)
+    elif args.command == 'aspiration':
+        aspiration(SEARCH_POSITIONS, args.depth, args.table_mb)
+    elif args.command == 'search':
+        for name in args.without:
+            setattr(sunfish, SWITCHES[name], False)
+        results = run_search(SEARCH_POSITIONS, args.depth, args.secs, args.table_mb,
+                             args.mailbox)
+        results['without'] = args.without
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                lost = compare(results, json.load(f))
+            if lost:
+                print("No longer solved:", ', '.join(lost))
+                sys.exit(1)
+    else:
+        parser.print_help()
@@ -0,0 +1,543 @@
+"""
+Bitboard backed position for the custom sunfish engine.
+
+``BitboardPosition`` has the same interface as ``sunfish_custom.Position`` so it can be handed
+straight to the ``Searcher``. Moves are still expressed as ``(i, j)`` tuples of indices into the
+rotated 120 character board, and the position keeps that board string around so evaluation
+(``value``) and printing work unchanged. Move generation however works on occupancy sets held
+as Python ints and on attack sets that are precomputed when the module is imported, so no
+empty square is ever visited.
+
+Squares on the bitboards are numbered 0 (a8) to 63 (h1). Unlike the board string, the
+bitboards are never rotated: they stay in the orientation of the starting position and
+``color`` records which side is to move (0 for the side that moved first). Rotating a bitboard
+is a bit reversal, which costs more in Python than translating square numbers through a table.
+"""
+from __future__ import print_function
+from collections import namedtuple
+import chess.sunfish_custom as sunfish
+
+try:
+    _maketrans = str.maketrans
+except AttributeError:  # Python 2
+    from string import maketrans as _maketrans
+
+###############################################################################
+# Precomputed tables
+###############################################################################
+
+FULL = (1 << 64) - 1
+BIT = tuple(1 << s for s in range(64))
+
+# Conversion between bitboard squares and indices of the 120 character board, for each side.
+# The board string is rotated for the second player, so their square s reads as 63-s.
+SQ120 = tuple(21 + 10 * (s // 8) + s % 8 for s in range(64))
+TO_120 = (SQ120, SQ120[::-1])
+FROM_120 = ([None] * 120, [None] * 120)
+for _s in range(64):
+    FROM_120[0][SQ120[_s]] = _s
+    FROM_120[1][SQ120[_s]] = 63 - _s
+FROM_120 = tuple(tuple(table) for table in FROM_120)
+
+NOT_FILE_A = sum(BIT[s] for s in range(64) if s % 8 != 0)
+NOT_FILE_H = sum(BIT[s] for s in range(64) if s % 8 != 7)
+# The ranks a pawn lands on after a single push from its home rank, and the promotion ranks
+RANK_3 = (0xff << 40, 0xff << 16)
+RANK_8 = (0xff, 0xff << 56)
+# The squares the rooks start on, seen from either side, as (west rook, east rook) of the
+# rotated board
+ROOK_CORNERS = ((56, 63), (7, 0))
+
+SWAP_CASE = _maketrans('PNBRQKpnbrqk', 'pnbrqkPNBRQK')
+
+
+def _targets(s, steps, slide):
+    """Squares reachable from s by the given (file, rank) steps on an empty board, grouped per
+    direction."""
+    rays = []
+    f, r = s % 8, s // 8
+    for df, dr in steps:
+        ray = []
+        nf, nr = f + df, r + dr
+        while 0 <= nf < 8 and 0 <= nr < 8:
+            ray.append(nr * 8 + nf)
+            if not slide:
+                break
+            nf, nr = nf + df, nr + dr
+        rays.append(ray)
+    return rays
+
+
+def _mask(squares):
+    return sum(BIT[s] for s in squares)
+
+
+KNIGHT_STEPS = ((1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1), (-1, -2))
+KING_STEPS = ((0, -1), (1, 0), (0, 1), (-1, 0), (1, -1), (1, 1), (-1, 1), (-1, -1))
+
+KNIGHT_ATTACKS = tuple(_mask(sum(_targets(s, KNIGHT_STEPS, False), [])) for s in range(64))
+KING_ATTACKS = tuple(_mask(sum(_targets(s, KING_STEPS, False), [])) for s in range(64))
+# Squares attacked by a pawn of either side. The first player's pawns move towards square 0.
+PAWN_ATTACKS = tuple(tuple(_mask(sum(_targets(s, steps, False), [])) for s in range(64))
+                     for steps in (((-1, -1), (1, -1)), ((-1, 1), (1, 1))))
+
+# Rays are split by whether the square numbers along them increase or decrease. The nearest
+# blocker on an increasing ray is its lowest set bit, on a decreasing ray its highest.
+ROOK_UP, ROOK_DOWN = ((1, 0), (0, 1)), ((-1, 0), (0, -1))
+BISHOP_UP, BISHOP_DOWN = ((1, 1), (-1, 1)), ((1, -1), (-1, -1))
+
+
+def _ray_table(steps):
+    return tuple(tuple(_mask(ray) for ray in _targets(s, steps, True)) for s in range(64))
+
+
+ROOK_RAYS_UP, ROOK_RAYS_DOWN = _ray_table(ROOK_UP), _ray_table(ROOK_DOWN)
+BISHOP_RAYS_UP, BISHOP_RAYS_DOWN = _ray_table(BISHOP_UP), _ray_table(BISHOP_DOWN)
+EAST_RAY = tuple(_mask(_targets(s, ((1, 0),), True)[0]) for s in range(64))
+WEST_RAY = tuple(_mask(_targets(s, ((-1, 0),), True)[0]) for s in range(64))
+
+
+def _slide(s, occ, rays_up, rays_down):
+    """Attack set of a slider on square s given the occupancy occ."""
+    attacks = 0
+    for ray in rays_up[s]:
+        blockers = ray & occ
+        if blockers:
+            b = (blockers & -blockers).bit_length() - 1
+            ray &= ~(FULL << (b + 1))
+        attacks |= ray
+    for ray in rays_down[s]:
+        blockers = ray & occ
+        if blockers:
+            b = blockers.bit_length() - 1
+            ray &= FULL << b
+        attacks |= ray
+    return attacks
+
+
+def _relevant(rays_up, rays_down):
+    """For each square, the squares of the rays whose occupancy decides the attack set: the
+    rays without their last square, which is attacked whether it is occupied or not."""
+    masks = []
+    for s in range(64):
+        mask = 0
+        for ray in rays_up[s]:
+            if ray:
+                mask |= ray & ~BIT[ray.bit_length() - 1]
+        for ray in rays_down[s]:
+            if ray:
+                mask |= ray ^ (ray & -ray)
+        masks.append(mask)
+    return tuple(masks)
+
+
+# The attack sets of the sliders are kept as they are worked out, per square and keyed on the
+# relevant occupancy, so each is only worked out once (a few thousand per square at most)
+ROOK_RELEVANT = _relevant(ROOK_RAYS_UP, ROOK_RAYS_DOWN)
+BISHOP_RELEVANT = _relevant(BISHOP_RAYS_UP, BISHOP_RAYS_DOWN)
+ROOK_ATTACKS = tuple({} for _ in range(64))
+BISHOP_ATTACKS = tuple({} for _ in range(64))
+
+
+def _rook(s, occ):
+    """Attack set of a rook on square s given the occupancy occ."""
+    occ &= ROOK_RELEVANT[s]
+    attacks = ROOK_ATTACKS[s].get(occ)
+    if attacks is None:
+        attacks = ROOK_ATTACKS[s][occ] = _slide(s, occ, ROOK_RAYS_UP, ROOK_RAYS_DOWN)
+    return attacks
+
+
+def _bishop(s, occ):
+    """Attack set of a bishop on square s given the occupancy occ."""
+    occ &= BISHOP_RELEVANT[s]
+    attacks = BISHOP_ATTACKS[s].get(occ)
+    if attacks is None:
+        attacks = BISHOP_ATTACKS[s][occ] = _slide(s, occ, BISHOP_RAYS_UP, BISHOP_RAYS_DOWN)
+    return attacks
+
+
+###############################################################################
+# Position
+###############################################################################
+
+# Index of the occupancy set of each piece type within the bitboards of a position
+_PIECE_INDEX = {'P': 2, 'N': 3, 'B': 4, 'R': 5, 'Q': 6, 'K': 7}
+_BITBOARDS = 8  # Offset of the bitboards within the position tuple
+# The index into the fixed board of each square of the board of the side to move, and the case
+# change between the two boards (which undoes itself), for either side to move
+FIXED = (tuple(range(120)), tuple(range(119, -1, -1)))
+CASE = (dict((p, p) for p in '.PNBRQKpnbrqk'), dict((p, p.swapcase()) for p in '.PNBRQKpnbrqk'))
+
+
+class _Board(object):
+    """The ``board`` of a ``BitboardPosition``: the board string of the side to move, as in
+    ``sunfish_custom.Position``. It is made from the fixed board the first time it is read, and
+    then kept in the position, so positions which are never looked at never rotate a string."""
+    def __get__(self, pos, cls=None):
+        if pos is None:
+            return self
+        board = pos.fixed[::-1].translate(SWAP_CASE) if pos.color else pos.fixed
+        pos.__dict__['board'] = board
+        return board
+
+
+def _add_pawn_moves(moves, targets, back, frame):
+    """Appends the moves of the pawns which reach targets from back squares behind."""
+    while targets:
+        low = targets & -targets
+        targets ^= low
+        t = low.bit_length() - 1
+        moves.append((frame[t + back], frame[t]))
+
+
+class BitboardPosition(namedtuple('BitboardPosition',
+                                  'fixed score wc bc ep kp hash color first second pawns '
+                                  'knights bishops rooks queens kings')):
+    """ A state of a chess game, as in ``sunfish_custom.Position``, plus
+    fixed -- the board string as the first player sees it, never rotated, see ``board``
+    color -- the side to move, 0 for the side that moved first
+    first, second -- occupancy of either side
+    pawns, knights, bishops, rooks, queens, kings -- occupancy per piece type of both sides
+    """
+    board = _Board()
+
+    @classmethod
+    def from_position(cls, pos, color=0):
+        """Builds the bitboards for a ``sunfish_custom.Position`` with the given side to
+        move."""
+        bbs = [0] * 8
+        for i, s in enumerate(FROM_120[color]):
+            p = pos.board[i]
+            if s is None or p == '.':
+                continue
+            bbs[color if p.isupper() else 1 - color] |= BIT[s]
+            bbs[_PIECE_INDEX[p.upper()]] |= BIT[s]
+        fixed = pos.board[::-1].translate(SWAP_CASE) if color else pos.board
+        return cls(fixed, pos.score, pos.wc, pos.bc, pos.ep, pos.kp, pos.hash, color, *bbs)
+
+    def to_position(self):
+        return sunfish.Position(self.board, *self[1:_BITBOARDS - 1]
+                                + (sunfish.piece_lists(self.board),))
+
+    def attacked(self, s, by):
+        """Whether square s is attacked by the pieces of side by."""
+        them = self.second if by else self.first
+        occ = self.first | self.second
+        return bool(PAWN_ATTACKS[1 - by][s] & self.pawns & them
+                    or KNIGHT_ATTACKS[s] & self.knights & them
+                    or KING_ATTACKS[s] & self.kings & them
+                    or _bishop(s, occ) & (self.bishops | self.queens) & them
+                    or _rook(s, occ) & (self.rooks | self.queens) & them)
+
+    def legal_moves(self):
+        """Yields the moves of ``gen_moves`` which don't leave the king of the side to move
+        in check, and castling only when the king doesn't castle out of or through check.
+        Capturing the opposing king ends the game, so it is always allowed."""
+        color = self.color
+        square = FROM_120[color]
+        for move in self.gen_moves():
+            i, j = move
+            if self.board[j] == 'k':
+                yield move
+                continue
+            if self.board[i] == 'K' and abs(j - i) == 2 and (
+                    self.attacked(square[i], 1 - color)
+                    or self.attacked(square[(i + j) // 2], 1 - color)):
+                continue
+            pos = self.move(move)
+            kings = pos.kings & (pos.second if color else pos.first)
+            if kings and pos.attacked(kings.bit_length() - 1, pos.color):
+                continue
+            yield move
+
+    def _piece_moves(self, moves, us, occ, targets):
+        """Appends the moves of our knights, bishops, rooks, queens and king onto targets,
+        piece by piece."""
+        frame = TO_120[self.color]
+        knights, kings = self.knights, self.kings
+        diagonal, straight = self.bishops | self.queens, self.rooks | self.queens
+        pieces = us & ~self.pawns
+        while pieces:
+            low = pieces & -pieces
+            pieces ^= low
+            s = low.bit_length() - 1
+            if low & knights:
+                reach = KNIGHT_ATTACKS[s]
+            elif low & kings:
+                reach = KING_ATTACKS[s]
+            else:
+                reach = 0
+                if low & diagonal:
+                    reach = _bishop(s, occ)
+                if low & straight:
+                    reach |= _rook(s, occ)
+            reach &= targets
+            i = frame[s]
+            while reach:
+                low = reach & -reach
+                reach ^= low
+                moves.append((i, frame[low.bit_length() - 1]))
+
+    def _castling_moves(self, moves, us, occ):
+        """Appends castling, when a rook could slide next to the king. For the second player
+        the board string is rotated, so their eastward slide runs towards lower square
+        numbers."""
+        color = self.color
+        frame = TO_120[color]
+        kings, rooks = self.kings & us, self.rooks & us
+        west_rook, east_rook = ROOK_CORNERS[color]
+        if self.wc[0] and rooks & BIT[west_rook]:
+            blockers = (WEST_RAY if color else EAST_RAY)[west_rook] & occ
+            if blockers:
+                k = blockers.bit_length() - 1 if color else (blockers & -blockers).bit_length() - 1
+                if kings & BIT[k]:
+                    moves.append((frame[k], frame[k] - 2))
+        if self.wc[1] and rooks & BIT[east_rook]:
+            blockers = (EAST_RAY if color else WEST_RAY)[east_rook] & occ
+            if blockers:
+                k = (blockers & -blockers).bit_length() - 1 if color else blockers.bit_length() - 1
+                if kings & BIT[k]:
+                    moves.append((frame[k], frame[k] + 2))
+
+    def _pawn_targets(self):
+        """The occupancy of our side and the other, and the squares our pawns can capture on:
+        the other side's pieces and the en passant and king passant squares."""
+        color = self.color
+        if color:
+            us, them = self.second, self.first
+        else:
+            us, them = self.first, self.second
+        targets = them
+        if self.ep:
+            targets |= BIT[FROM_120[color][self.ep]]
+        if self.kp:
+            targets |= BIT[FROM_120[color][self.kp]]
+        return us, them, targets
+
+    def gen_moves(self):
+        """The moves of the side to move, as a list: pawn pushes, double pushes and captures,
+        then the moves of the other pieces one by one, then castling."""
+        color = self.color
+        us, them, targets = self._pawn_targets()
+        frame = TO_120[color]
+        occ = us | them
+        empty = ~occ & FULL
+        pawns = self.pawns & us
+        if color:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3[1]) << 8) & empty
+            west = ((pawns & NOT_FILE_H) << 9) & targets
+            east = ((pawns & NOT_FILE_A) << 7) & targets
+            back = -8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_3[0]) >> 8) & empty
+            west = ((pawns & NOT_FILE_A) >> 9) & targets
+            east = ((pawns & NOT_FILE_H) >> 7) & targets
+            back = 8
+        moves = []
+        _add_pawn_moves(moves, single, back, frame)
+        _add_pawn_moves(moves, double, 2*back, frame)
+        _add_pawn_moves(moves, west, back + back//8, frame)
+        _add_pawn_moves(moves, east, back - back//8, frame)
+        self._piece_moves(moves, us, occ, ~us & FULL)
+        self._castling_moves(moves, us, occ)
+        return moves
+
+    def gen_captures(self):
+        """ The moves of gen_moves() which Searcher.moves() counts as captures: captures,
+        promotions, and moves onto or next to the king passant square. """
+        color = self.color
+        us, them, targets = self._pawn_targets()
+        frame = TO_120[color]
+        occ = us | them
+        pawns = self.pawns & us
+        if color:
+            single = (pawns << 8) & ~occ & RANK_8[1]
+            west = ((pawns & NOT_FILE_H) << 9) & targets
+            east = ((pawns & NOT_FILE_A) << 7) & targets
+            back = -8
+        else:
+            single = (pawns >> 8) & ~occ & RANK_8[0]
+            west = ((pawns & NOT_FILE_A) >> 9) & targets
+            east = ((pawns & NOT_FILE_H) >> 7) & targets
+            back = 8
+        moves = []
+        _add_pawn_moves(moves, single, back, frame)
+        _add_pawn_moves(moves, west, back + back//8, frame)
+        _add_pawn_moves(moves, east, back - back//8, frame)
+        # The other pieces capture the king on any of the squares it passed when castling
+        targets = them
+        if self.kp:
+            for j in (self.kp - 1, self.kp, self.kp + 1):
+                targets |= BIT[FROM_120[color][j]]
+        self._piece_moves(moves, us, occ, targets & ~us & FULL)
+        return moves
+
+    def gen_quiets(self):
+        """ The moves of gen_moves() which gen_captures() leaves out, in the same order. """
+        color = self.color
+        if color:
+            us, them = self.second, self.first
+        else:
+            us, them = self.first, self.second
+        frame = TO_120[color]
+        occ = us | them
+        empty = ~occ & FULL
+        pawns = self.pawns & us
+        if color:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3[1]) << 8) & empty
+            single &= ~RANK_8[1]
+            back = -8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_3[0]) >> 8) & empty
+            single &= ~RANK_8[0]
+            back = 8
+        moves = []
+        _add_pawn_moves(moves, single, back, frame)
+        _add_pawn_moves(moves, double, 2*back, frame)
+        # Moves onto or next to the king passant square are captures of the king
+        targets = empty
+        if self.kp:
+            for j in (self.kp - 1, self.kp, self.kp + 1):
+                targets &= ~BIT[FROM_120[color][j]]
+        self._piece_moves(moves, us, occ, targets)
+        self._castling_moves(moves, us, occ)
+        return moves
+
+    def rotate(self):
+        """ Rotates the board, preserving enpassant. Only the side to move changes, the fixed
+        board stays as it is. """
+        return BitboardPosition(
+            self.fixed, -self.score, self.bc, self.wc,
+            119-self.ep if self.ep else 0,
+            119-self.kp if self.kp else 0,
+            sunfish.rotate_hash(self.hash, self.wc, self.bc, self.ep, self.kp),
+            1-self.color, *self[_BITBOARDS:])
+
+    def nullmove(self):
+        """ Like rotate, but clears ep and kp """
+        h = self.hash ^ sunfish.zobrist_ep[self.ep] ^ sunfish.zobrist_kp[self.kp]
+        return BitboardPosition(
+            self.fixed, -self.score, self.bc, self.wc, 0, 0,
+            sunfish.rotate_hash(h, self.wc, self.bc, 0, 0),
+            1-self.color, *self[_BITBOARDS:])
+
+    def move(self, move):
+        i, j = move
+        color = self.color
+        # The move is made on the fixed board, whose squares and case depend on the side to move
+        at, case = FIXED[color], CASE[color]
+        fixed = self.fixed
+        p, q = case[fixed[at[i]]], case[fixed[at[j]]]
+        put = lambda board, i, p: board[:i] + p + board[i+1:]
+        z = sunfish.zobrist_pieces
+        # Copy variables and reset ep and kp
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        score = self.score + sunfish.move_value(p, q, i, j, self.ep, self.kp)
+        h = self.hash ^ (sunfish.zobrist_castling[wc, bc] ^ sunfish.zobrist_ep[self.ep]
+                         ^ sunfish.zobrist_kp[self.kp])
+        square = FROM_120[color]
+        bbs = list(self[_BITBOARDS:])
+        # Actual move, clearing whatever stood on the target square
+        h ^= z[p][i] ^ z[p][j] ^ z[q][j]
+        a, b = at[i], at[j]
+        if a < b:
+            fixed = fixed[:a] + '.' + fixed[a+1:b] + case[p] + fixed[b+1:]
+        else:
+            fixed = fixed[:b] + case[p] + fixed[b+1:a] + '.' + fixed[a+1:]
+        to = BIT[square[j]]
+        if q != '.':
+            bbs[1 - color] ^= to
+            bbs[_PIECE_INDEX[q.upper()]] ^= to
+        moved = BIT[square[i]] | to
+        bbs[color] ^= moved
+        bbs[_PIECE_INDEX[p]] ^= moved
+        # Castling rights, we move the rook or capture the opponent's
+        if i == sunfish.A1:
+            wc = (False, wc[1])
+        if i == sunfish.H1:
+            wc = (wc[0], False)
+        if j == sunfish.A8:
+            bc = (bc[0], False)
+        if j == sunfish.H8:
+            bc = (False, bc[1])
+        # Castling
+        if p == 'K':
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                corner = sunfish.A1 if j < i else sunfish.H1
+                h ^= z['R'][corner] ^ z['R'][kp]
+                fixed = put(fixed, at[corner], '.')
+                fixed = put(fixed, at[kp], case['R'])
+                rook = BIT[square[corner]] | BIT[square[kp]]
+                bbs[color] ^= rook
+                bbs[_PIECE_INDEX['R']] ^= rook
+        # Pawn promotion, double move and en passant capture
+        if p == 'P':
+            if sunfish.A8 <= j <= sunfish.H8:
+                h ^= z['P'][j] ^ z['Q'][j]
+                fixed = put(fixed, at[j], case['Q'])
+                bbs[_PIECE_INDEX['P']] ^= to
+                bbs[_PIECE_INDEX['Q']] ^= to
+            if j - i == 2*sunfish.N:
+                ep = i + sunfish.N
+            if j - i in (sunfish.N+sunfish.W, sunfish.N+sunfish.E) and q == '.':
+                captured = case[fixed[at[j+sunfish.S]]]
+                h ^= z[captured][j+sunfish.S]
+                fixed = put(fixed, at[j+sunfish.S], '.')
+                if captured != '.':
+                    bit = BIT[square[j+sunfish.S]]
+                    bbs[color if captured.isupper() else 1 - color] ^= bit
+                    bbs[_PIECE_INDEX[captured.upper()]] ^= bit
+        # We rotate the returned position, so it's ready for the next player
+        ep, kp = 119-ep if ep else 0, 119-kp if kp else 0
+        h = (sunfish.swap_halves(h) ^ sunfish.zobrist_castling[bc, wc]
+             ^ sunfish.zobrist_ep[ep] ^ sunfish.zobrist_kp[kp])
+        return BitboardPosition(fixed, -score, bc, wc, ep, kp, h, 1-color, *bbs)
+
+    # Evaluation only reads the board string, so it is shared with the mailbox position
+    value = getattr(sunfish.Position.value, '__func__', sunfish.Position.value)
+
+
+def from_fen(fen):
+    """Builds the position described by a FEN string. The halfmove and fullmove counters are
+    ignored. When black is to move the board is rotated, as in a game."""
+    fields = fen.split()
+    placement, turn = fields[0], fields[1] if len(fields) > 1 else 'w'
+    castling = fields[2] if len(fields) > 2 else '-'
+    passant = fields[3] if len(fields) > 3 else '-'
+    rows = []
+    for row in placement.split('/'):
+        for n in '12345678':
+            row = row.replace(n, '.' * int(n))
+        if len(row) != 8:
+            raise ValueError("Invalid FEN placement: %s" % placement)
+        rows.append(' ' + row + '\n')
+    if len(rows) != 8:
+        raise ValueError("Invalid FEN placement: %s" % placement)
+    board = ' ' * 9 + '\n' + ' ' * 9 + '\n' + ''.join(rows) + ' ' * 9 + '\n' + ' ' * 9 + '\n'
+    # The rights to castle with the rook on the a-file and h-file, as seen from either side
+    wc = ('Q' in castling, 'K' in castling)
+    bc = ('k' in castling, 'q' in castling)
+    ep = sunfish.parse(passant) if passant != '-' else 0
+    score = sum(sunfish.pst[p][i] for i, p in enumerate(board) if p.isupper()) \
+        - sum(sunfish.pst[p.upper()][119 - i] for i, p in enumerate(board) if p.islower())
+    pos = sunfish.Position(board, score, wc, bc, ep, 0, sunfish.zobrist(board, wc, bc, ep, 0),
+                           sunfish.piece_lists(board))
+    if turn == 'b':
+        return BitboardPosition.from_position(pos.rotate(), color=1)
+    return BitboardPosition.from_position(pos)
+
+
+def initial_position(castling=True):
+    """The starting position, with the first player to move."""
+    wc = bc = (castling, castling)
+    pos = sunfish.Position(sunfish.initial, 0, wc, bc, 0, 0,
+                           sunfish.zobrist(sunfish.initial, wc, bc, 0, 0),
+                           sunfish.piece_lists(sunfish.initial))
+    return BitboardPosition.from_position(pos)
@@ -0,0 +1,216 @@
+"""
+Opening book for the chess engine.
+
+The book is a binary file of fixed size entries, sorted by position key: the Zobrist hash of a
+position (as played by Sunfish, without castling), a move of the side to move there, and the
+weight of the move, the number of games in which it was played. The file is opened with mmap and
+searched by bisection, so opening a book costs no time, however large it is.
+
+Build a book from PGN files with::
+
+    python -m chess.book games.pgn more_games.pgn --output book.bin --plies 24
+"""
+from __future__ import print_function
+import argparse
+import mmap
+import random
+import re
+import struct
+from chess.bitboard import initial_position
+import chess.sunfish_custom as sunfish
+
+MAGIC = b'SFBOOK1\n'
+# Position key, move as i*120+j on the board of the side to move, weight
+ENTRY = struct.Struct('>QHH')
+MAX_WEIGHT = 0xffff
+# Plies of each game which go into the book by default
+BOOK_PLIES = 24
+
+
+class BookError(Exception):
+    """Raised when a file isn't an opening book."""
+    pass
+
+
+class OpeningBook:
+    """A read only opening book in the file at path, see the module documentation."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise BookError("%s is not an opening book" % path)
+            f.seek(0, 2)
+            self.size = (f.tell() - len(MAGIC)) // ENTRY.size
+            # An empty map isn't allowed, and there is nothing to look up in an empty book
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def __len__(self):
+        return self.size
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self.map, len(MAGIC) + index * ENTRY.size)
+
+    def moves(self, h):
+        """Returns the (move, weight) pairs of the book for the position hash h."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.size:
+            key, move, weight = self._entry(lo)
+            if key != h:
+                break
+            found.append((divmod(move, 120), weight))
+            lo += 1
+        return found
+
+    def choose(self, pos):
+        """Picks a book move for pos at random, in proportion to the weights, or returns None
+        when pos isn't in the book. Moves which aren't legal in pos are never chosen."""
+        legal = set(pos.gen_moves())
+        moves = [(move, weight) for move, weight in self.moves(pos.hash) if move in legal]
+        if not moves:
+            return None
+        pick = random.randint(1, sum(weight for _, weight in moves))
+        for move, weight in moves:
+            pick -= weight
+            if pick <= 0:
+                return move
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+###############################################################################
+# Building books
+###############################################################################
+
+def read_pgn(lines):
+    """Yields the moves of each game in PGN text, as lists of SAN strings (e.g. ``'Nf3'``)."""
+    movetext = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:
+                yield _san_moves(' '.join(movetext))
+                movetext = []
+        elif line and not line.startswith('%'):
+            movetext.append(line)
+    if movetext:
+        yield _san_moves(' '.join(movetext))
+
+
+def _san_moves(text):
+    text = re.sub(r'\{[^}]*\}|;[^\n]*|\$\d+', ' ', text)
+    # Drop variations, which may be nested
+    while '(' in text:
+        stripped = re.sub(r'\([^()]*\)', ' ', text)
+        if stripped == text:
+            break
+        text = stripped
+    moves = []
+    for token in text.split():
+        token = re.sub(r'^\d+\.+', '', token)
+        if token and token not in ('1-0', '0-1', '1/2-1/2', '*'):
+            moves.append(token)
+    return moves
+
+
+def parse_san(pos, san):
+    """Returns the move (i, j) of pos written san, or None if it is ambiguous, illegal or
+    can't be played by Sunfish: castling (which is switched off) and underpromotions."""
+    san = san.rstrip('+#!?')
+    match = re.match(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$', san)
+    if not match:
+        return None
+    piece, file_, rank, target, promotion = match.groups()
+    piece = piece or 'P'
+    if promotion not in (None, 'Q') or (promotion and piece != 'P'):
+        return None
+
+    def square(i):
+        # The board of the second player is rotated
+        return sunfish.render(119 - i if pos.color else i)
+
+    candidates = [(i, j) for i, j in pos.legal_moves()
+                  if pos.board[i] == piece and square(j) == target
+                  and (file_ is None or square(i)[0] == file_)
+                  and (rank is None or square(i)[1] == rank)]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def san(pos, move):
+    """Returns the move (i, j) of pos written in SAN, e.g. ``'Nbd7'``, ``'exd5'`` or ``'O-O+'``.
+    """
+    i, j = move
+
+    def square(k):
+        return sunfish.render(119 - k if pos.color else k)
+
+    piece = pos.board[i]
+    if piece == 'K' and abs(j - i) == 2:
+        text = 'O-O' if square(j)[0] == 'g' else 'O-O-O'
+    elif piece == 'P':
+        text = square(j) if i % 10 == j % 10 else square(i)[0] + 'x' + square(j)
+        if sunfish.A8 <= j <= sunfish.H8:
+            text += '=Q'
+    else:
+        others = [k for k, l in pos.legal_moves() if l == j and k != i and pos.board[k] == piece]
+        prefix = ''
+        if others:
+            if all(square(k)[0] != square(i)[0] for k in others):
+                prefix = square(i)[0]
+            elif all(square(k)[1] != square(i)[1] for k in others):
+                prefix = square(i)[1]
+            else:
+                prefix = square(i)
+        text = piece + prefix + ('x' if pos.board[j].islower() else '') + square(j)
+    after = pos.move(move)
+    if sunfish.is_check(after):
+        text += '+' if any(True for _ in after.legal_moves()) else '#'
+    return text
+
+
+def build_book(pgn_paths, output, plies=BOOK_PLIES, min_weight=1):
+    """Writes the book of the first plies moves of the games in the PGN files to output. Moves
+    played in fewer than min_weight games are left out. A game is followed until its first move
+    Sunfish can't play. Returns the number of games read and of entries written."""
+    counts = {}
+    games = 0
+    for path in pgn_paths:
+        with open(path) as f:
+            for moves in read_pgn(f):
+                games += 1
+                pos = initial_position(castling=False)
+                for token in moves[:plies]:
+                    move = parse_san(pos, token)
+                    if move is None:
+                        break
+                    key = (pos.hash, move[0] * 120 + move[1])
+                    counts[key] = counts.get(key, 0) + 1
+                    pos = pos.move(move)
+    entries = sorted((h, move, min(weight, MAX_WEIGHT))
+                     for (h, move), weight in counts.items() if weight >= min_weight)
+    with open(output, 'wb') as f:
+        f.write(MAGIC)
+        for entry in entries:
+            f.write(ENTRY.pack(*entry))
+    return games, len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds an opening book from PGN files")
+    parser.add_argument('pgn', nargs='+', help="PGN files to read the games from")
+    parser.add_argument('-o', '--output', default='book.bin')
+    parser.add_argument('-p', '--plies', type=int, default=BOOK_PLIES,
+                        help="moves of each game to put in the book, counting both sides")
+    parser.add_argument('-w', '--min-weight', type=int, default=1,
+                        help="games a move must be played in to go into the book")
+    args = parser.parse_args()
+    games, entries = build_book(args.pgn, args.output, args.plies, args.min_weight)
+    print("{} games, {} book entries written to {}".format(games, entries, args.output))
@@ -0,0 +1,71 @@
+"""
+On-disk cache of the replies Sunfish found, kept across games.
+
+Each entry maps the Zobrist hash of a position with Sunfish to move to the reply it played there
+(e.g. ``'e7e5'``), with the score and depth of the search that found it. The entries are held in
+an SQLite file, which both the engine and the Sunfish process open. When the file holds more than
+``max_entries`` entries, those used least recently are dropped.
+"""
+from __future__ import print_function
+import sqlite3
+import time
+from collections import namedtuple
+
+# Entries kept by default, about 100 bytes each on disk
+CACHE_ENTRIES = 100000
+# Seconds to wait for the other process to finish writing to the file
+CACHE_TIMEOUT = 5
+
+Reply = namedtuple('Reply', 'move score depth')
+
+
+def _key(h):
+    """SQLite integers are signed 64 bit, the hashes are unsigned."""
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+class ReplyCache:
+    """Position hash to ``Reply`` table in the SQLite file at path, created if need be."""
+    def __init__(self, path, max_entries=CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=CACHE_TIMEOUT)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS replies (hash INTEGER PRIMARY KEY, "
+                            "move TEXT, score INTEGER, depth INTEGER, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS replies_used ON replies (used)")
+
+    def get(self, h):
+        """Returns the ``Reply`` stored for the position hash h, or None."""
+        row = self.db.execute("SELECT move, score, depth FROM replies WHERE hash = ?",
+                              (_key(h),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute("UPDATE replies SET used = ? WHERE hash = ?", (time.time(), _key(h)))
+        return Reply(*row)
+
+    def put(self, h, move, score, depth):
+        """Stores a reply for the position hash h, unless a deeper one is stored already."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO replies SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS "
+                            "(SELECT 1 FROM replies WHERE hash = ? AND depth > ?)",
+                            (_key(h), move, score, depth, time.time(), _key(h), depth))
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM replies WHERE hash IN "
+                                "(SELECT hash FROM replies ORDER BY used LIMIT ?)", (excess,))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+
+    def stats(self):
+        """The lookups of this process that found an entry or not, and the entries stored."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,132 @@
+"""
+Request/response channel between the chess engine and the Sunfish process.
+
+Both directions share one duplex pipe. Every request is a ``Message`` with a type, an id and a
+payload, and the answer to it carries the same id. An answer that arrives after its request timed
+out is therefore recognised and dropped, rather than being taken as the answer to the next
+request. The client end keeps a latency histogram per request type.
+"""
+from __future__ import print_function
+import multiprocessing as mp
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import count
+
+# Request types. A move is answered with a code, the reply move or None, and the statistics of the
+# search which found the reply or None (see sunfish_custom.Searcher._record).
+MOVE = 'move'  # payload: (moves played so far, user's move), answer: (code, reply, stats)
+PING = 'ping'  # payload: None, answer: None
+# Progress of a request, sent before its answer with the same id. A move is followed by the
+# (depth, best move, score) of each iteration of the search for the reply.
+INFO = 'info'
+# Answer type for requests the other end failed to handle, the payload is the error message
+ERROR = 'error'
+
+Message = namedtuple('Message', 'kind id payload')
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                  1, 2, 5, 10)
+
+
+class ChannelError(Exception):
+    """Raised when the other end answers a request with an error."""
+    pass
+
+
+class ChannelTimeout(ChannelError):
+    """Raised when a request isn't answered in time."""
+    pass
+
+
+class LatencyHistogram:
+    """Counts round trip times in the buckets of ``LATENCY_BOUNDS``."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, secs):
+        self.counts[bisect_left(LATENCY_BOUNDS, secs)] += 1
+        self.total += secs
+        self.worst = max(self.worst, secs)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile, or the worst time seen if that
+        is the last bucket."""
+        n = sum(self.counts)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if n and seen >= q / 100.0 * n:
+                return LATENCY_BOUNDS[i] if i < len(LATENCY_BOUNDS) else self.worst
+        return 0.0
+
+    def stats(self):
+        n = sum(self.counts)
+        return {'count': n, 'mean': self.total / n if n else 0.0, 'p50': self.percentile(50),
+                'p99': self.percentile(99), 'max': self.worst,
+                'buckets': dict(zip(LATENCY_BOUNDS + (float('inf'),), self.counts))}
+
+
+class Channel:
+    """One end of the duplex pipe. The engine end sends requests with ``request()``, the Sunfish
+    end answers them with ``recv()`` and ``reply()`` (or ``error()``)."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = count(1)
+        self.latency = {}
+
+    @classmethod
+    def pair(cls):
+        """Returns both ends of a new channel."""
+        a, b = mp.Pipe(duplex=True)
+        return cls(a), cls(b)
+
+    def request(self, kind, payload=None, timeout=None, progress=None):
+        """Sends a request and waits for its answer, at most timeout seconds if given. Returns
+        the payload of the answer. progress is called with the payload of each ``INFO`` message
+        sent about the request in the meantime."""
+        request_id = next(self.ids)
+        start = time.time()
+        self.conn.send(Message(kind, request_id, payload))
+        while True:
+            if timeout is not None and not self.conn.poll(max(0, start + timeout - time.time())):
+                raise ChannelTimeout("No answer to %s request %d within %s seconds"
+                                     % (kind, request_id, timeout))
+            answer = self.conn.recv()
+            if answer.id == request_id and answer.kind == INFO:
+                if progress is not None:
+                    progress(answer.payload)
+            elif answer.id == request_id:
+                break
+            # Otherwise it answers a request that has timed out, which we have given up on
+        self.latency.setdefault(kind, LatencyHistogram()).add(time.time() - start)
+        if answer.kind == ERROR:
+            raise ChannelError(answer.payload)
+        return answer.payload
+
+    def poll(self, timeout=0):
+        """Whether a message is waiting to be received."""
+        return self.conn.poll(timeout)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def reply(self, request, payload):
+        self.conn.send(Message(request.kind, request.id, payload))
+
+    def inform(self, request, payload):
+        """Tells the other end about the progress of a request, see ``INFO``."""
+        self.conn.send(Message(INFO, request.id, payload))
+
+    def error(self, request, message):
+        self.conn.send(Message(ERROR, request.id, message))
+
+    def stats(self):
+        """Latency statistics per request type, see ``LatencyHistogram.stats``."""
+        return dict((kind, histogram.stats()) for kind, histogram in self.latency.items())
+
+    def close(self):
+        self.conn.close()
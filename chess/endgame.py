@@ -0,0 +1,235 @@
+"""
+Endgame tables for the custom sunfish engine.
+
+A table covers a king and a queen or rook against a lone king (KQK, KRK). It holds one byte per
+position: the squares of the strong king, the strong piece and the weak king, and the side to
+move. The byte is 0 for an impossible position, 1 for a draw and n >= 2 when the strong side
+mates in n-2 plies. The tables are built by retrograde analysis, starting from the mates and
+walking the moves backwards, and are opened with mmap, so they cost nothing to load.
+
+Build the tables with::
+
+    python -m chess.endgame --output tables
+
+Squares are numbered 0 (a8) to 63 (h1), as on the bitboards. The tables don't depend on the
+colour of the pieces, so they are probed on the board of the side to move, which Sunfish rotates.
+"""
+from __future__ import print_function
+import argparse
+import mmap
+import os
+from collections import deque
+import chess.sunfish_custom as sunfish
+
+# The strong pieces tables can be built for
+TABLE_PIECES = 'QR'
+ILLEGAL, DRAW = 0, 1
+# Index of the side to move in a table
+STRONG, WEAK = 0, 1
+
+KING_STEPS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+PIECE_STEPS = {'R': ((-1, 0), (1, 0), (0, -1), (0, 1)),
+               'Q': KING_STEPS}
+
+
+def _on_board(x, y):
+    return 0 <= x < 8 and 0 <= y < 8
+
+
+KING_MOVES = tuple(tuple(s + dy*8 + dx for dx, dy in KING_STEPS
+                         if _on_board(s % 8 + dx, s // 8 + dy))
+                   for s in range(64))
+ADJACENT = [False] * 4096
+for _s in range(64):
+    for _t in KING_MOVES[_s]:
+        ADJACENT[_s*64 + _t] = True
+
+
+def _rays(s, steps):
+    rays = []
+    for dx, dy in steps:
+        x, y, ray = s % 8 + dx, s // 8 + dy, []
+        while _on_board(x, y):
+            ray.append(y*8 + x)
+            x, y = x + dx, y + dy
+        rays.append(tuple(ray))
+    return tuple(rays)
+
+
+RAYS = dict((p, tuple(_rays(s, steps) for s in range(64))) for p, steps in PIECE_STEPS.items())
+# BETWEEN[p][a*64+b] is the set of squares between a and b as a bit mask when a piece p on a
+# attacks b on an empty board, and None otherwise
+BETWEEN = {}
+for _p in PIECE_STEPS:
+    BETWEEN[_p] = [None] * 4096
+    for _s in range(64):
+        for _ray in RAYS[_p][_s]:
+            for _n, _t in enumerate(_ray):
+                BETWEEN[_p][_s*64 + _t] = sum(1 << q for q in _ray[:_n])
+
+
+def index(side, strong_king, piece, weak_king):
+    return ((side*64 + strong_king)*64 + piece)*64 + weak_king
+
+
+###############################################################################
+# Generating tables
+###############################################################################
+
+def generate(p):
+    """Returns the table of king and p against king as a bytearray, see the module
+    documentation."""
+    between = BETWEEN[p]
+    rays = RAYS[p]
+
+    def attacks(piece, target, blocker):
+        line = between[piece*64 + target]
+        return line is not None and not line >> blocker & 1
+
+    table = bytearray(2 * 64**3)
+    # The legal moves of each position with the weak king to move, which are counted down as
+    # the positions they lead to turn out to be lost
+    moves_left = bytearray(64**3)
+    queue = deque()
+    for sk in range(64):
+        for sp in range(64):
+            if sp == sk:
+                continue
+            for wk in range(64):
+                if wk == sk or wk == sp or ADJACENT[sk*64 + wk]:
+                    continue
+                check = attacks(sp, wk, sk)
+                if not check:
+                    table[index(STRONG, sk, sp, wk)] = DRAW
+                table[index(WEAK, sk, sp, wk)] = DRAW
+                n = 0
+                for t in KING_MOVES[wk]:
+                    # Taking the piece is a move too, which draws
+                    if not ADJACENT[sk*64 + t] and (t == sp or not attacks(sp, t, sk)):
+                        n += 1
+                moves_left[(sk*64 + sp)*64 + wk] = n
+                if check and n == 0:
+                    table[index(WEAK, sk, sp, wk)] = 2
+                    queue.append((WEAK, sk, sp, wk))
+
+    # Positions are taken in order of their distance to mate, so the first move found to win a
+    # position with the strong side to move is the fastest, and the last move found to lose a
+    # position with the weak side to move the slowest.
+    while queue:
+        side, sk, sp, wk = queue.popleft()
+        value = table[index(side, sk, sp, wk)] + 1
+        if side == WEAK:
+            # The strong side got here by a king or piece move, from a position in which it
+            # didn't give check
+            for k in KING_MOVES[sk]:
+                if k != sp and k != wk and not ADJACENT[k*64 + wk] and not attacks(sp, wk, k):
+                    i = index(STRONG, k, sp, wk)
+                    if table[i] == DRAW:
+                        table[i] = value
+                        queue.append((STRONG, k, sp, wk))
+            for ray in rays[sp]:
+                for q in ray:
+                    if q == sk or q == wk:
+                        break
+                    i = index(STRONG, sk, q, wk)
+                    if table[i] == DRAW and not attacks(q, wk, sk):
+                        table[i] = value
+                        queue.append((STRONG, sk, q, wk))
+        else:
+            # The weak king got here from a neighbouring square
+            for k in KING_MOVES[wk]:
+                if k != sp and k != sk and not ADJACENT[sk*64 + k]:
+                    j = (sk*64 + sp)*64 + k
+                    moves_left[j] -= 1
+                    if moves_left[j] == 0:
+                        table[index(WEAK, sk, sp, k)] = value
+                        queue.append((WEAK, sk, sp, k))
+    return table
+
+
+def write_table(p, directory):
+    """Generates the table of king and p against king, and writes it to directory. Returns
+    the path of the file."""
+    path = os.path.join(directory, 'K%sK.bin' % p)
+    with open(path, 'wb') as f:
+        f.write(generate(p))
+    return path
+
+
+###############################################################################
+# Probing tables
+###############################################################################
+
+def _square(i):
+    """The table square of an index of the 120 character board."""
+    return (i // 10 - 2) * 8 + i % 10 - 1
+
+
+class EndgameTables:
+    """The tables found in a directory, opened with mmap."""
+    def __init__(self, directory):
+        self.tables = {}
+        for p in TABLE_PIECES:
+            path = os.path.join(directory, 'K%sK.bin' % p)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self.tables[p] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def probe(self, pos):
+        """Returns the score of pos for the side to move: ``MATE_UPPER - n`` when it mates in n
+        plies, ``-MATE_UPPER + n`` when it is mated in n plies and 0 for a draw. Returns None
+        when pos isn't covered by the tables, or can't be reached."""
+        pieces = [(i, c) for i, c in enumerate(pos.board) if c.isalpha()]
+        if len(pieces) == 2 and pieces[0][1] in 'Kk' and pieces[1][1] in 'Kk':
+            # Two kings draw, unless one has just taken a defended piece
+            return None if abs(pieces[0][0] - pieces[1][0]) in (1, 9, 10, 11) else 0
+        if len(pieces) != 3:
+            return None
+        kings = dict((c, i) for i, c in pieces if c in 'Kk')
+        others = [(i, c) for i, c in pieces if c not in 'Kk']
+        if len(kings) != 2 or others[0][1].upper() not in self.tables:
+            return None
+        i, c = others[0]
+        side = STRONG if c.isupper() else WEAK
+        strong_king, weak_king = (kings['K'], kings['k']) if side == STRONG else (kings['k'],
+                                                                                  kings['K'])
+        value = self.tables[c.upper()][index(side, _square(strong_king), _square(i),
+                                             _square(weak_king))]
+        if value == ILLEGAL:
+            return None
+        if value == DRAW:
+            return 0
+        score = sunfish.MATE_UPPER - (value - 2)
+        return score if side == STRONG else -score
+
+    def best_move(self, pos):
+        """Returns the best move of pos with its score, as ``Searcher.search`` gives them, or
+        None when pos isn't covered by the tables. Winning moves mate as fast as possible, and
+        losing moves hold out as long as possible."""
+        if self.probe(pos) is None:
+            return None
+        best = None
+        for move in pos.gen_moves():
+            score = self.probe(pos.move(move))
+            # None when the move leaves our king to be taken
+            if score is not None and (best is None or -score > best[1]):
+                best = move, -score
+        return best
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds endgame tables")
+    parser.add_argument('-o', '--output', default='tables', help="directory to write them to")
+    parser.add_argument('-p', '--pieces', default=TABLE_PIECES,
+                        help="strong pieces to build the tables of, out of " + TABLE_PIECES)
+    args = parser.parse_args()
+    if not set(args.pieces) <= set(TABLE_PIECES):
+        parser.error("no tables for " + args.pieces)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for p in args.pieces:
+        print("Wrote", write_table(p, args.output))
@@ -5,9 +5,32 @@ and the chess logic underneath.
 """
 from __future__ import print_function
 import multiprocessing as mp
+import atexit
+import json
 import time
 import sys
+from collections import namedtuple
 import chess.sunfish_custom as sunfish
+from chess.bitboard import initial_position
+from chess.book import OpeningBook
+from chess.cache import ReplyCache
+from chess.channel import Channel, ChannelError, MOVE, PING
+from chess.uci import UCIEngine
+
+# Seconds to wait for an answer from Sunfish. A search takes a few seconds at most.
+SUNFISH_TIMEOUT = 30
+# Replies found by a search of at least this depth are played from the reply cache
+CACHE_DEPTH = 6
+# The best move of a search is stable once this many iterations in a row have found it, with
+# scores no further than STABLE_SCORE_SWING apart, and the last of at least STABLE_DEPTH plies
+STABLE_ITERATIONS = 3
+STABLE_DEPTH = 5
+STABLE_SCORE_SWING = 50
+
+# The state of Sunfish's search for a reply after one of its iterations, see input_bwe(): the
+# depth, best move (e.g. 'e7e5') and score, whether the move is stable, and the square of the
+# piece the arm picks up first, the one captured if any
+SearchProgress = namedtuple('SearchProgress', 'depth move score stable square')
 
 
 class HiddenPrints:
@@ -64,6 +87,38 @@ class ChessState:
         self.col_labels = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
         self.row_labels = ['8', '7', '6', '5', '4', '3', '2', '1']
 
+        # Sunfish's view of the game, as played in its process, and the legal moves of the user
+        # in it (e.g. 'e2e4'), so illegal moves are caught without asking Sunfish
+        self.pos = initial_position(castling=False)
+        self.legal_moves = self.gen_legal_moves()
+        # The moves played so far, which Sunfish uses to check that it is in sync with us
+        self.moves = []
+
+    def gen_legal_moves(self):
+        """Returns the set of legal moves of the user in the current position."""
+        if self.pos.color != 0:
+            return set()
+        return set(sunfish.render(i) + sunfish.render(j) for i, j in self.pos.legal_moves())
+
+    def is_legal(self, move):
+        """Checks if a move (e.g. ``'e2e4'``) is legal for the user to play."""
+        return move in self.legal_moves
+
+    def position_after(self, move):
+        """Returns the Sunfish position after a move (e.g. ``'e2e4'``) of the side to move,
+        without playing it."""
+        i, j = sunfish.parse(move[0:2]), sunfish.parse(move[2:4])
+        if self.pos.color:  # The board is rotated when Sunfish is to move
+            i, j = 119 - i, 119 - j
+        return self.pos.move((i, j))
+
+    def push_move(self, move):
+        """Plays a move (e.g. ``'e2e4'``) of either side on the Sunfish position, and finds
+        the legal moves of the position reached. The board list is updated separately."""
+        self.pos = self.position_after(move)
+        self.legal_moves = self.gen_legal_moves()
+        self.moves.append(move)
+
     def get_bwe(self):
         """Returns the current game state as a BWE list."""
         bwe = []
@@ -201,6 +256,7 @@ class ChessState:
         # Update internal board
         self.board[self.move_to_index] = self.board[self.move_from_index]
         self.board[self.move_from_index] = '.'
+        self.push_move(self.user_move)
         if self.debug:
             print(self.board)
 
@@ -211,15 +267,68 @@ class ChessEngine:
 
     It's main purpose is to take a BWE matrix as the user's potential move and provide an
     analysis of this move by either reporting back its invalidity or the AI's response.
+
+    With ``ponder`` set, Sunfish keeps searching while it waits for the user's move, on the move
+    it expects the user to play. If the user then plays that move the reply comes back almost
+    immediately.
+
+    With ``workers`` above 1, Sunfish searches in that many processes at once, which share
+    their transposition table (see ``sunfish_custom.ParallelSearcher``).
+
+    Requests to Sunfish that aren't answered within ``timeout`` seconds raise an
+    ``EngineError``. The round trip times of the requests are kept in ``latency_stats()``.
+
+    With ``cache`` set to a file name, the replies Sunfish finds are kept in that file (see
+    ``chess.cache.ReplyCache``). A position found there, searched to at least ``cache_depth``,
+    is answered straight away from the file rather than by a new search.
+
+    With ``book`` set to the file name of an opening book (see ``chess.book``), the positions
+    in the book are answered with one of its moves, without a search.
+
+    With ``endgames`` set to a directory of endgame tables (see ``chess.endgame``), Sunfish
+    plays the positions they hold perfectly and without a search.
+
+    With ``server`` set to a ``chess.server.EngineServer``, the game is played as one of the
+    games of the server, rather than by a Sunfish process of its own. ``workers`` and
+    ``endgames`` are then those of the server, and ``ponder`` is ignored: the server only
+    searches once the user has moved.
+
+    With ``uci`` set to the command of a UCI engine (see ``chess.uci.UCIEngine``), the replies
+    are asked of that engine rather than of Sunfish.
+
+    After each reply ``last_stats`` holds the statistics of the turn: where the reply came from,
+    how long it took, and the statistics of Sunfish's search, if there was one (see
+    ``sunfish_custom.Searcher._record``). With ``stats_log`` set to a file name, they are also
+    added to that file, as one line of JSON per turn.
     """
-    def __init__(self, debug=False, suppress_sunfish=True):
+    def __init__(self, debug=False, suppress_sunfish=True, ponder=True,
+                 workers=sunfish.SMP_WORKERS, timeout=SUNFISH_TIMEOUT, cache=None,
+                 cache_depth=CACHE_DEPTH, book=None, endgames=None, server=None,
+                 uci=None, stats_log=None):
         self.debug = debug
         self.suppress_sunfish = suppress_sunfish
+        self.ponder = ponder
+        self.workers = workers
+        self.timeout = timeout
         self.state = ChessState(debug=self.debug)
-
-        self.command_q = mp.Queue()
-        self.reply_q = mp.Queue()
-        self.valid_q = mp.Queue()
+        self.cache_path = cache
+        self.cache = ReplyCache(cache) if cache is not None else None
+        self.cache_depth = cache_depth
+        self.book = OpeningBook(book) if book is not None else None
+        self.endgames = endgames
+        self.server = server
+        self.stats_log = stats_log
+        self.last_stats = None
+
+        if server is not None:
+            self.channel = None
+            self.game_id = server.new_game()
+            return
+        if uci is not None:
+            # Answers requests like the channel to Sunfish
+            self.channel = UCIEngine(uci)
+            return
+        self.channel, self.sunfish_channel = Channel.pair()
         if self.debug:
             print("Starting Sunfish...")
         if suppress_sunfish:
@@ -231,16 +340,103 @@ class ChessEngine:
     def start_sunfish_process(self):
         """Spins up external process for Sunfish AI.
 
-        Process communicates with three queues, the command queue (for user moves), the valid queue
-        for confirming if the user queue is valid, and the reply queue for the Sunfish computer
-        move response.
+        Process communicates over a single channel (see ``chess.channel``). Each user move is
+        sent as a request, which Sunfish answers with whether the move is valid and its reply.
         """
-        chess_ai = mp.Process(target=sunfish.main, args=(self.command_q, self.reply_q,
-                                                         self.valid_q))
-        chess_ai.daemon = True
+        chess_ai = mp.Process(target=sunfish.main, args=(self.sunfish_channel, self.ponder,
+                                                         self.workers, self.cache_path,
+                                                         self.endgames))
+        # A daemon process may not start processes of its own, such as the helpers of a parallel
+        # search. Those must be stopped explicitly when we exit.
+        chess_ai.daemon = self.workers == 1
         chess_ai.start()
+        if not chess_ai.daemon:
+            atexit.register(chess_ai.terminate)
 
-    def input_bwe(self, bwe):
+    def request(self, kind, payload=None, progress=None):
+        """Sends a request to Sunfish and returns its answer. progress is called with the
+        progress Sunfish reports meanwhile, see ``chess.channel.INFO``."""
+        try:
+            if self.server is not None:
+                return self.server.request(self.game_id, kind, payload, timeout=self.timeout,
+                                           progress=progress)
+            return self.channel.request(kind, payload, timeout=self.timeout, progress=progress)
+        except ChannelError as e:
+            raise EngineError(str(e))
+
+    def ping(self):
+        """Returns the round trip time to Sunfish in seconds."""
+        start = time.time()
+        self.request(PING)
+        return time.time() - start
+
+    def latency_stats(self):
+        """Round trip times to Sunfish per request type, see ``chess.channel.Channel``."""
+        if self.server is not None:
+            return self.server.latency_stats(self.game_id)
+        return self.channel.stats()
+
+    def book_reply(self, move):
+        """Looks up the reply to the user's move (e.g. ``'e2e4'``) in the opening book. Returns
+        it with its code for ``input_bwe``, or None if the position isn't in the book."""
+        if self.book is None:
+            return None
+        reply = self.book.choose(self.state.position_after(move))
+        if reply is None:
+            return None
+        # Sunfish plays on the rotated board
+        return 3, sunfish.render(119 - reply[0]) + sunfish.render(119 - reply[1])
+
+    def cached_reply(self, move):
+        """Looks up the reply to the user's move (e.g. ``'e2e4'``) in the reply cache. Returns
+        it with its code for ``input_bwe``, as Sunfish would, or None if it has to be searched.
+        """
+        if self.cache is None:
+            return None
+        pos = self.state.position_after(move)
+        entry = self.cache.get(pos.hash)
+        if entry is None or entry.depth < self.cache_depth:
+            return None
+        # Make sure the reply is legal here, in case another position has the same hash
+        i, j = sunfish.parse(entry.move[0:2]), sunfish.parse(entry.move[2:4])
+        if (119 - i, 119 - j) not in pos.gen_moves():
+            return None
+        return 2 if entry.score == sunfish.MATE_UPPER else 3, entry.move
+
+    def follow_search(self, move, progress):
+        """Returns the callback of ``request`` which passes the iterations of the search for
+        the reply to the user's move (e.g. ``'e2e4'``) on to progress, as ``SearchProgress``."""
+        board = list(self.state.board)
+        i, j = self.state.convert_to_index(move[0:2]), self.state.convert_to_index(move[2:4])
+        board[j], board[i] = board[i], '.'
+        # The best move so far, how many iterations in a row found it, and its last score
+        streak = [None, 0, None]
+
+        def info(payload):
+            depth, best, score = payload
+            if best == streak[0] and abs(score - streak[2]) <= STABLE_SCORE_SWING:
+                streak[1] += 1
+            else:
+                streak[0], streak[1] = best, 1
+            streak[2] = score
+            # The endgame tables (depth 0) and mates are certain
+            stable = (depth == 0 or abs(score) >= sunfish.MATE_LOWER
+                      or streak[1] >= STABLE_ITERATIONS and depth >= STABLE_DEPTH)
+            captures = board[self.state.convert_to_index(best[2:4])].isupper()
+            progress(SearchProgress(depth, best, score, stable, best[2:4] if captures
+                                    else best[0:2]))
+        return info
+
+    def log_stats(self, move, reply, source, secs, search):
+        """Keeps the statistics of a turn in ``last_stats``, and adds them to the stats log."""
+        self.last_stats = {'time': time.time(), 'turn': len(self.state.moves) // 2,
+                           'move': move, 'reply': reply, 'source': source, 'secs': secs,
+                           'search': search}
+        if self.stats_log is not None:
+            with open(self.stats_log, 'a') as f:
+                f.write(json.dumps(self.last_stats) + '\n')
+
+    def input_bwe(self, bwe, progress=None):
         """Takes in the latest BWE and tries to input that to Sunfish AI.
 
         Returns:
@@ -270,6 +466,19 @@ class ChessEngine:
         * Pieces are single character strings.
         * Locations are two character strings e.g. 'a2'
         * Moves are 4 character strings e.g. 'a2a4'
+
+        Raises an ``EngineError`` if Sunfish doesn't answer in time. The game state is left as it
+        was, so the same BWE can be input again.
+
+        A reply found in the opening book or the reply cache is returned without asking
+        Sunfish, which catches up with the game when the next move is sent.
+
+        The statistics of a turn with a reply are kept in ``last_stats``, see ``log_stats``.
+
+        While Sunfish searches for the reply, progress is called with a ``SearchProgress`` after
+        each iteration of the search, in the calling thread. Once the best move is ``stable`` it
+        rarely changes any more, so the arm can set off towards ``square`` before the search
+        ends. The reply returned is the one to play, which may still be another move.
         """
 
         if self.debug:
@@ -278,12 +487,27 @@ class ChessEngine:
             move = self.state.get_bwe_move(bwe)  # get the move from the bwe matrix
         except EngineError:
             return -1, None
+        if not self.state.is_legal(move[1]):
+            if self.debug:
+                print("Move is not legal: ", move)
+            return 0, move  # caught here, so Sunfish doesn't have to be asked
+
         if self.debug:
             print("Passing the move to the Sunfish AI: ", move)
 
-        self.command_q.put(move[1])  # pass the move to the chess ai
-
-        valid = self.valid_q.get(block=True)
+        start = time.time()
+        source, cached = 'book', self.book_reply(move[1])
+        if cached is None:
+            source, cached = 'cache', self.cached_reply(move[1])
+        if cached is not None:
+            if self.debug:
+                print("Reply found in the book or cache: ", cached[1])
+            (valid, reply), stats = cached, None
+        else:
+            # pass the move to the chess ai, along with the game so far
+            source = 'search'
+            follow = self.follow_search(move[1], progress) if progress is not None else None
+            valid, reply, stats = self.request(MOVE, (self.state.moves, move[1]), follow)
 
         if self.debug:
             print("Validity from Sunfish AI: ", valid)
@@ -298,7 +522,6 @@ class ChessEngine:
             if valid == 2:
                 print("Validity was 2 so computer made checkmate")
             self.state.update_board(bwe)  # update the board with the latest move
-            reply = self.reply_q.get(block=True)  # get the return move from Sunfish
             if self.debug:
                 print("Sunfish replied with: ", reply)
 
@@ -321,6 +544,8 @@ class ChessEngine:
             # Second, update the chess state with the reply for reference on next turn
             self.state.board[move_to_index] = self.state.board[move_from_index]
             self.state.board[move_from_index] = '.'
+            self.state.push_move(reply)
+            self.log_stats(move[1], reply, source, time.time() - start, stats)
 
             if self.debug:
                 print("Computer move from: ", move_from_pos)
@@ -363,21 +588,13 @@ class ChessEngine:
         if True:
             time.sleep(3)
             print("putting in a2a3")
-            self.command_q.put('a2a3')
-
-            validity = self.valid_q.get(block=True)
+            validity, reply, _ = self.request(MOVE, ([], 'a2a3'))
             print("VALIDITY: ", validity)
-
-            while self.reply_q.empty():
-                time.sleep(1)
-                print("reply q is empty")
-            print("I JUST GOT: ", self.reply_q.get())
+            print("I JUST GOT: ", reply)
     
             time.sleep(3)
             print("putting in a3a4")
-            self.command_q.put('a3a7')
-
-            validity = self.valid_q.get(block=True)
+            validity, reply, _ = self.request(MOVE, (['a2a3', reply], 'a3a7'))
             print("VALIDITY 2: ", validity)
     
             time.sleep(3)
@@ -0,0 +1,274 @@
+"""
+Self-play matches of the custom sunfish engine, to check the strength of a change.
+
+Two configurations of the engine, A and B, play each other: each is the engine with some of the
+constants of ``sunfish_custom`` changed (e.g. ``LMR=False``), and without changes both are the
+engine as it is. Every opening is played twice, with each configuration as white once, and the
+games are played in parallel by a pool of processes. Each move is searched to a fixed number of
+nodes (reproducible) or for a fixed time. The games are written to a PGN file and their results
+to a JSON lines file as they finish, and the match is summed up as games per hour, nodes per
+second and the wins, draws and losses of A, with its score and Elo difference at 95% confidence.
+
+    python -m chess.selfplay --games 40 --workers 4 --nodes 5000 -a LMR=False
+
+Games are played under the full rules, castling included, and drawn by repetition, the 50 move
+rule, insufficient material or after ``--max-plies`` plies.
+"""
+from __future__ import print_function
+import argparse
+import ast
+import json
+import math
+import multiprocessing as mp
+import time
+from contextlib import contextmanager
+from chess.bitboard import from_fen
+from chess.book import san
+import chess.sunfish_custom as sunfish
+
+# Positions the games start from, each played once with either configuration as white
+OPENINGS = [
+    ('Open game', 'rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'),
+    ('Sicilian', 'rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'),
+    ('French', 'rnbqkbnr/pppp1ppp/4p3/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'),
+    ('Caro-Kann', 'rnbqkbnr/pp1ppppp/2p5/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2'),
+    ("Queen's Gambit Declined", 'rnbqkbnr/ppp2ppp/4p3/3p4/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3'),
+    ('Slav', 'rnbqkbnr/pp2pppp/2p5/3p4/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3'),
+    ("King's Indian", 'rnbqkb1r/pppppp1p/5np1/8/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3'),
+    ('English', 'rnbqkbnr/pppp1ppp/8/4p3/2P5/8/PP1PPPPP/RNBQKBNR w KQkq - 0 2'),
+    ('Ruy Lopez', 'r1bqkbnr/1ppp1ppp/p1n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 0 4'),
+    ('Italian', 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'),
+    ('Nimzo-Indian', 'rnbqk2r/pppp1ppp/4pn2/8/1bPP4/2N5/PP2PPPP/R1BQKBNR w KQkq - 2 4'),
+    ('Pirc', 'rnbqkb1r/ppp1pp1p/3p1np1/8/3PP3/2N5/PPP2PPP/R1BQKBNR w KQkq - 0 4'),
+]
+# Nodes searched per move by default
+SELFPLAY_NODES = 3000
+# Games still going after this many plies are drawn
+SELFPLAY_MAX_PLIES = 300
+# Transposition table of each side, smaller than in a game as many games run at once
+SELFPLAY_TABLE_MB = 8
+
+
+@contextmanager
+def settings(changes):
+    """Changes constants of sunfish_custom for the duration of the block."""
+    saved = dict((name, getattr(sunfish, name)) for name in changes)
+    for name, value in changes.items():
+        setattr(sunfish, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(sunfish, name, value)
+
+
+def parse_settings(args):
+    """Reads ``NAME=VALUE`` arguments into a dict of changes to sunfish_custom constants."""
+    changes = {}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if not name.isupper() or not hasattr(sunfish, name):
+            raise ValueError("No such setting: %s" % name)
+        changes[name] = ast.literal_eval(value)
+    return changes
+
+
+def _insufficient(board):
+    pieces = [p for p in board if p.isalpha() and p not in 'Kk']
+    return len(pieces) <= 1 and all(p in 'NBnb' for p in pieces)
+
+
+def play_game(game):
+    """Plays one game, given as a dict with the opening, the configuration of each side and
+    the limits of a move, and returns its record."""
+    pos = from_fen(game['fen'])
+    sides = [(game['white'], game['settings'][game['white']]),
+             (game['black'], game['settings'][game['black']])]
+    searchers = []
+    for _, changes in sides:
+        # The table is made with the settings of its side, whose TABLE_MB wins over table_mb
+        with settings(changes):
+            searchers.append(sunfish.Searcher(changes.get('TABLE_MB', game['table_mb'])))
+    nodes, secs = {game['white']: 0, game['black']: 0}, {game['white']: 0.0, game['black']: 0.0}
+    moves, seen, quiet = [], {pos.hash: 1}, 0
+    while True:
+        legal = list(pos.legal_moves())
+        if not legal:
+            if sunfish.is_check(pos):
+                result, reason = ('0-1' if pos.color == 0 else '1-0'), 'checkmate'
+            else:
+                result, reason = '1/2-1/2', 'stalemate'
+            break
+        reason = ('repetition' if seen[pos.hash] >= 3 else '50 moves' if quiet >= 100
+                  else 'insufficient material' if _insufficient(pos.board)
+                  else 'move limit' if len(moves) >= game['max_plies'] else None)
+        if reason is not None:
+            result = '1/2-1/2'
+            break
+        name, changes = sides[pos.color]
+        searcher = searchers[pos.color]
+        start = time.time()
+        with settings(changes):
+            searched = pos if sunfish.BITBOARD_SEARCH else pos.to_position()
+            if game['movetime'] is not None:
+                move, _ = searcher.search(searched, secs=game['movetime'], deadline=start +
+                                          sunfish.DEADLINE_FACTOR * game['movetime'])
+            else:
+                move, _ = searcher.search(searched, nodes=game['nodes'])
+        secs[name] += time.time() - start
+        nodes[name] += searcher.nodes
+        if move not in legal:
+            # Every move loses the king, so the search may pick one which does straight away
+            move = legal[0]
+        moves.append(san(pos, move))
+        quiet = 0 if pos.board[move[0]] == 'P' or pos.board[move[1]].islower() else quiet + 1
+        pos = pos.move(move)
+        seen[pos.hash] = seen.get(pos.hash, 0) + 1
+    return dict(game, result=result, reason=reason, plies=len(moves), moves=moves, nodes=nodes,
+                secs=secs)
+
+
+def pgn(record):
+    """The game of a record of play_game() in PGN."""
+    tags = [('Event', 'Sunfish self-play'), ('Date', record['date']),
+            ('Round', record['round']), ('White', record['white']),
+            ('Black', record['black']), ('Result', record['result']),
+            ('FEN', record['fen']), ('SetUp', '1'), ('Opening', record['opening']),
+            ('Termination', record['reason'])]
+    fields = record['fen'].split()
+    number = int(fields[5]) if len(fields) > 5 else 1
+    tokens = []
+    black = len(fields) > 1 and fields[1] == 'b'
+    if black:
+        tokens.append('%d...' % number)
+    for move in record['moves']:
+        if not black:
+            tokens.append('%d.' % number)
+        else:
+            number += 1
+        tokens.append(move)
+        black = not black
+    tokens.append(record['result'])
+    lines, line = [], ''
+    for token in tokens:
+        if len(line) + len(token) >= 80:
+            lines.append(line)
+            line = ''
+        line = (line + ' ' + token).strip()
+    lines.append(line)
+    return ''.join('[%s "%s"]\n' % tag for tag in tags) + '\n' + '\n'.join(lines) + '\n\n'
+
+
+def elo(score):
+    """The Elo difference expected to give a score between 0 and 1."""
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return 400 * math.log10(score / (1 - score))
+
+
+def summary(records, elapsed):
+    """Games per hour, nodes per second and the results of A, with the score and Elo
+    difference of A at 95% confidence."""
+    scores = []
+    for record in records:
+        if record['result'] == '1/2-1/2':
+            scores.append(0.5)
+        else:
+            winner = record['white'] if record['result'] == '1-0' else record['black']
+            scores.append(1.0 if winner == 'A' else 0.0)
+    n = len(scores)
+    mean = sum(scores) / n
+    deviation = math.sqrt(sum((s - mean) ** 2 for s in scores) / n)
+    margin = 1.96 * deviation / math.sqrt(n)
+    nodes = sum(sum(record['nodes'].values()) for record in records)
+    secs = sum(sum(record['secs'].values()) for record in records)
+    return {'games': n, 'games/hour': n * 3600.0 / elapsed, 'nodes/s': nodes / max(secs, 1e-9),
+            'wins': scores.count(1.0), 'draws': scores.count(0.5), 'losses': scores.count(0.0),
+            'score': mean, 'score margin': margin, 'elo': elo(mean),
+            'elo low': elo(mean - margin), 'elo high': elo(mean + margin)}
+
+
+def read_openings(path):
+    """Reads opening positions from a file of FEN or EPD lines."""
+    openings = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split(';')[0].strip()
+            if line and not line.startswith('#'):
+                openings.append(('%s:%d' % (path, number), line))
+    return openings
+
+
+def run(games, workers, settings_a, settings_b, nodes=SELFPLAY_NODES, movetime=None,
+        openings=OPENINGS, max_plies=SELFPLAY_MAX_PLIES, table_mb=SELFPLAY_TABLE_MB,
+        pgn_path=None, results_path=None, verbose=True):
+    """Plays a match of games games between A and B with workers processes, and returns the
+    records of the games and the summary() of the match."""
+    if games < 1:
+        raise ValueError("A match needs at least one game, not %d" % games)
+    date = time.strftime('%Y.%m.%d')
+    match = []
+    for index in range(games):
+        name, fen = openings[(index // 2) % len(openings)]
+        white, black = ('A', 'B') if index % 2 == 0 else ('B', 'A')
+        match.append({'round': index + 1, 'date': date, 'opening': name, 'fen': fen,
+                      'white': white, 'black': black,
+                      'settings': {'A': settings_a, 'B': settings_b}, 'nodes': nodes,
+                      'movetime': movetime, 'max_plies': max_plies, 'table_mb': table_mb})
+    pgn_file = open(pgn_path, 'a') if pgn_path else None
+    results_file = open(results_path, 'a') if results_path else None
+    pool = mp.Pool(workers)
+    records = []
+    start = time.time()
+    try:
+        for record in pool.imap_unordered(play_game, match):
+            records.append(record)
+            if pgn_file is not None:
+                pgn_file.write(pgn(record))
+                pgn_file.flush()
+            if results_file is not None:
+                results_file.write(json.dumps(record) + '\n')
+                results_file.flush()
+            if verbose:
+                print("Game {:3d}/{}: {} - {} {:7s} {:22s} {:3d} plies  ({})".format(
+                    len(records), games, record['white'], record['black'], record['result'],
+                    record['reason'], record['plies'], record['opening']))
+    finally:
+        pool.close()
+        pool.join()
+        for f in (pgn_file, results_file):
+            if f is not None:
+                f.close()
+    return records, summary(records, time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plays the engine against itself")
+    parser.add_argument('-n', '--games', type=int, default=2 * len(OPENINGS))
+    parser.add_argument('-w', '--workers', type=int, default=mp.cpu_count())
+    parser.add_argument('-a', nargs='*', default=[], metavar='NAME=VALUE',
+                        help="sunfish_custom constants changed for configuration A")
+    parser.add_argument('-b', nargs='*', default=[], metavar='NAME=VALUE',
+                        help="sunfish_custom constants changed for configuration B")
+    parser.add_argument('--nodes', type=int, default=SELFPLAY_NODES, help="nodes per move")
+    parser.add_argument('--movetime', type=float,
+                        help="seconds per move, instead of a number of nodes")
+    parser.add_argument('--openings', help="file of FEN positions to start the games from")
+    parser.add_argument('--max-plies', type=int, default=SELFPLAY_MAX_PLIES)
+    parser.add_argument('-m', '--table-mb', type=int, default=SELFPLAY_TABLE_MB)
+    parser.add_argument('--pgn', default='selfplay.pgn', help="file to add the games to")
+    parser.add_argument('--results', default='selfplay.jsonl',
+                        help="file to add the results to, one JSON object per game")
+    args = parser.parse_args()
+    if args.games < 1:
+        parser.error("--games must be at least 1")
+    try:
+        settings_a, settings_b = parse_settings(args.a), parse_settings(args.b)
+    except (ValueError, SyntaxError) as e:
+        parser.error(str(e))
+    _, result = run(args.games, args.workers, settings_a, settings_b, args.nodes, args.movetime,
+                    read_openings(args.openings) if args.openings else OPENINGS,
+                    args.max_plies, args.table_mb, args.pgn, args.results)
+    print("A: {}  B: {}".format(' '.join(args.a) or 'default', ' '.join(args.b) or 'default'))
+    print("{games} games, {games/hour:.0f} games/hour, {nodes/s:.0f} nodes/s".format(**result))
+    print("A wins {wins}, draws {draws}, loses {losses}: score {score:.3f} +- {score margin:.3f}, "
+          "Elo {elo:+.0f} ({elo low:+.0f} to {elo high:+.0f}) at 95%".format(**result))
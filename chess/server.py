@@ -0,0 +1,331 @@
+"""
+Engine server hosting many games at once, e.g. for several robot boards run from one host.
+
+Each game has an id, and its own position and moves, kept in the process of the server. The
+searches of all games are run by one pool of worker processes, which share a transposition table
+held in shared memory (Python 3.8 or newer), so a worker is never cold and the memory of the
+table is paid once. When more searches wait than there are free workers, the next one goes to
+the game that has used the least search time so far. Each game searches for ``secs`` per move,
+and never more than its share of a total ``budget``, if it has one.
+
+Requests to the server have the kinds and payloads of ``chess.channel``, so a ``ChessEngine``
+given ``server=`` uses it in place of a Sunfish process of its own::
+
+    server = EngineServer(workers=2)
+    engines = [ChessEngine(server=server) for board in boards]
+    ...
+    server.close()
+"""
+from __future__ import print_function
+import multiprocessing as mp
+import os
+import re
+import threading
+import time
+from itertools import count
+from chess.bitboard import initial_position
+from chess.cache import ReplyCache
+from chess.channel import INFO, MOVE, PING, ChannelError, ChannelTimeout, LatencyHistogram
+from chess.endgame import EndgameTables
+import chess.sunfish_custom as sunfish
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, each worker keeps a table of its own
+    shared_memory = None
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+
+# Search processes serving all the games
+SERVER_WORKERS = 2
+# Search time per move of a game, and the least it is given when its budget runs low
+SERVER_SECS = 2
+SERVER_MIN_SECS = 0.1
+# The remaining budget of a game is spread over this many moves
+SERVER_MOVES_LEFT = 30
+
+
+class Game:
+    """The state of one game hosted by the server."""
+    def __init__(self, game_id, secs, budget):
+        self.id = game_id
+        self.secs = secs
+        self.budget = budget
+        self.start_pos = initial_position(castling=False)
+        if not sunfish.BITBOARD_SEARCH:
+            self.start_pos = self.start_pos.to_position()
+        self.pos = self.start_pos
+        # The moves played so far, as in sunfish_custom.play()
+        self.history = []
+        # The search in flight for the game, whose reply is still to be played
+        self.job = None
+        # Search seconds used, seconds waited for a free worker, searches and nodes
+        self.used = 0.0
+        self.waited = 0.0
+        self.searches = 0
+        self.nodes = 0
+        self.latency = {}
+
+    def move_secs(self):
+        """The search time of the next move."""
+        if self.budget is None:
+            return self.secs
+        share = (self.budget - self.used) / SERVER_MOVES_LEFT
+        return max(SERVER_MIN_SECS, min(self.secs, share))
+
+    def stats(self):
+        return {'moves': len(self.history), 'searches': self.searches, 'nodes': self.nodes,
+                'used': self.used, 'waited': self.waited, 'budget': self.budget}
+
+
+def _worker(name, table_mb, replace, endgames, cache, jobs, results):
+    """Runs in a worker process of the EngineServer. Searches each position put on jobs for its
+    time, and puts the result on results, tagged with the id of the job, with no move if the
+    search failed. The (depth, move, score) of each iteration go there first, tagged with
+    ``INFO``."""
+    parent = os.getppid()
+    block = shared_memory.SharedMemory(name=name) if name is not None else None
+    table = (sunfish.TranspositionTable(table_mb, replace, buffer=block.buf)
+             if block is not None else None)
+    searcher = sunfish.Searcher(table_mb, replace, table=table,
+                                endgames=EndgameTables(endgames) if endgames else None)
+    cache = ReplyCache(cache) if cache is not None else None
+    while True:
+        try:
+            job = jobs.get(timeout=1)
+        except Empty:
+            # Don't outlive the server, it may have been terminated
+            if os.getppid() != parent:
+                break
+            continue
+        if job is None:
+            break
+        job_id, pos, secs = job
+        start = time.time()
+
+        def info(depth, best, score, job_id=job_id):
+            if best is not None:
+                reply = sunfish.render(119 - best[0]) + sunfish.render(119 - best[1])
+                results.put((INFO, job_id, (depth, reply, score)))
+        try:
+            move, score = searcher.search(pos, secs=secs, info=info,
+                                          deadline=start + sunfish.DEADLINE_FACTOR * secs)
+        except Exception as e:
+            # The worker stays up for the other games, the request gets a ChannelError
+            print("Search of job %d failed: %r" % (job_id, e))
+            move, score = None, 0
+        if move is not None and cache is not None:
+            reply = sunfish.render(119 - move[0]) + sunfish.render(119 - move[1])
+            cache.put(pos.hash, reply, score, searcher.depth)
+        stats = sunfish.render_search(searcher.last_search) if move is not None else None
+        results.put((job_id, move, score, searcher.nodes, time.time() - start, stats))
+    searcher.tp.release()
+    if block is not None:
+        block.close()
+    if cache is not None:
+        cache.close()
+
+
+class EngineServer:
+    """Plays any number of games with a pool of search processes, see the module
+    documentation. The games are played in the threads calling request(), which may be many
+    at once. close() the server when done."""
+    def __init__(self, workers=SERVER_WORKERS, table_mb=sunfish.TABLE_MB,
+                 replace=sunfish.TABLE_REPLACE, endgames=None, cache=None):
+        self.block = None
+        if shared_memory is not None:
+            self.block = shared_memory.SharedMemory(
+                create=True, size=sunfish.TranspositionTable.nbytes(table_mb))
+        self.jobs = mp.Queue()
+        self.results = mp.Queue()
+        self.workers = []
+        for _ in range(workers):
+            worker = mp.Process(target=_worker, args=(self.block and self.block.name, table_mb,
+                                                      replace, endgames, cache, self.jobs,
+                                                      self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.games = {}
+        self.game_ids = count(1)
+        self.job_ids = count(1)
+        # Guards everything below and the games. Waiting requests are woken when a result comes.
+        self.lock = threading.Condition()
+        # Searches waiting for a worker, as (job id, game id, position, seconds, queued at)
+        self.pending = []
+        self.idle = workers
+        # The answers of finished searches, for the requests still waiting on them, and the
+        # iterations of the searches not yet passed on to those requests
+        self.waiting = set()
+        self.answers = {}
+        self.infos = {}
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def new_game(self, secs=SERVER_SECS, budget=None):
+        """Starts a game, whose moves are searched for secs seconds, and for budget seconds
+        in total if given. Returns the id of the game."""
+        with self.lock:
+            game = Game(next(self.game_ids), secs, budget)
+            self.games[game.id] = game
+            return game.id
+
+    def end_game(self, game_id):
+        """Forgets a game. Its search, if one is running, is thrown away."""
+        with self.lock:
+            self.games.pop(game_id, None)
+            self.pending = [job for job in self.pending if job[1] != game_id]
+
+    def request(self, game_id, kind, payload=None, timeout=None, progress=None):
+        """Answers a request of the kind and with the payload of ``chess.channel`` for a game,
+        within timeout seconds if given. Returns the payload of the answer, and raises a
+        ``ChannelError`` like a channel would. progress is called with the payload of each
+        ``INFO`` about the request meanwhile, without the lock of the server held."""
+        start = time.time()
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                raise ChannelError("Unknown game: %s" % game_id)
+            if kind == PING:
+                answer = None
+            elif kind == MOVE:
+                answer = self._move(game, payload, timeout, progress)
+            else:
+                raise ChannelError("Unknown request: %s" % kind)
+            game.latency.setdefault(kind, LatencyHistogram()).add(time.time() - start)
+            return answer
+
+    def _move(self, game, payload, timeout, progress):
+        """Plays the user's move in the game and searches the reply, as
+        sunfish_custom.play() does. Called with the lock held."""
+        moves, command = payload
+        if list(moves) != game.history:
+            # The caller gave up waiting for one of our answers. Continue from the game as it
+            # knows it.
+            try:
+                if len(moves) % 2:
+                    raise ValueError("Not the user's turn after %d moves" % len(moves))
+                game.pos = sunfish.replay(game.start_pos, moves)
+            except ValueError as e:
+                raise ChannelError(str(e))
+            game.history = list(moves)
+            game.job = None
+
+        match = re.match('([a-h][1-8])'*2, command)
+        move = match and (sunfish.parse(match.group(1)), sunfish.parse(match.group(2)))
+        if move not in game.pos.gen_moves():
+            return 0, None, None
+        game.pos = game.pos.move(move)
+        game.history.append(command)
+        if game.pos.score <= -sunfish.MATE_LOWER:
+            return 1, None, None
+
+        job_id = next(self.job_ids)
+        game.job = job_id
+        # A search still waiting for the game answers a request given up on
+        self.pending = [job for job in self.pending if job[1] != game.id]
+        self.pending.append((job_id, game.id, game.pos, game.move_secs(), time.time()))
+        self.waiting.add(job_id)
+        self._dispatch()
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while True:
+                infos = self.infos.pop(job_id, [])
+                if infos and progress is not None:
+                    # The caller may take its time, other games must not wait for it
+                    self.lock.release()
+                    try:
+                        for info in infos:
+                            progress(info)
+                    finally:
+                        self.lock.acquire()
+                    continue
+                if job_id in self.answers:
+                    break
+                left = deadline - time.time() if deadline is not None else None
+                if left is not None and left <= 0:
+                    raise ChannelTimeout("No answer to move %s of game %s within %s seconds"
+                                         % (command, game.id, timeout))
+                self.lock.wait(left)
+        finally:
+            self.waiting.discard(job_id)
+            self.infos.pop(job_id, None)
+        answer = self.answers.pop(job_id)
+        if isinstance(answer, ChannelError):
+            raise answer
+        return answer
+
+    def _dispatch(self):
+        """Hands waiting searches to the idle workers, those of the games which used the least
+        time first. Called with the lock held."""
+        while self.idle and self.pending:
+            job = min(self.pending, key=lambda job: self.games[job[1]].used)
+            self.pending.remove(job)
+            job_id, game_id, pos, secs, queued = job
+            self.games[game_id].waited += time.time() - queued
+            self.jobs.put((job_id, pos, secs))
+            self.idle -= 1
+
+    def _collect(self):
+        """Runs in a thread of the server, and plays the results of the workers in their
+        games."""
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            if result[0] == INFO:
+                _, job_id, info = result
+                with self.lock:
+                    if job_id in self.waiting:
+                        self.infos.setdefault(job_id, []).append(info)
+                        self.lock.notify_all()
+                continue
+            job_id, move, score, nodes, secs, stats = result
+            with self.lock:
+                self.idle += 1
+                game = next((game for game in self.games.values() if game.job == job_id), None)
+                if game is not None:
+                    game.job = None
+                    game.used += secs
+                    game.searches += 1
+                    game.nodes += nodes
+                if move is None:
+                    answer = ChannelError("No move to play")
+                else:
+                    # The board of the engine's side is rotated
+                    reply = sunfish.render(119 - move[0]) + sunfish.render(119 - move[1])
+                    answer = 2 if score == sunfish.MATE_UPPER else 3, reply, stats
+                    if game is not None:
+                        game.pos = game.pos.move(move)
+                        game.history.append(reply)
+                if job_id in self.waiting:
+                    self.answers[job_id] = answer
+                self._dispatch()
+                self.lock.notify_all()
+
+    def latency_stats(self, game_id):
+        """Round trip times of the requests of a game, as ``chess.channel.Channel.stats``."""
+        with self.lock:
+            game = self.games[game_id]
+            return dict((kind, histogram.stats()) for kind, histogram in game.latency.items())
+
+    def stats(self):
+        """The games with their moves, searches, nodes and seconds used and waited, and the
+        workers and searches waiting."""
+        with self.lock:
+            return {'games': dict((game.id, game.stats()) for game in self.games.values()),
+                    'workers': len(self.workers), 'idle': self.idle,
+                    'pending': len(self.pending)}
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.collector.join()
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
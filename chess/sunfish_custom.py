@@ -2,11 +2,25 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import os
 import re
 import sys
 import time
-from itertools import count
-from collections import OrderedDict, namedtuple
+import random
+import signal
+import multiprocessing as mp
+from array import array
+from collections import namedtuple
+from chess.cache import ReplyCache
+from chess.channel import MOVE, PING
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, parallel search is unavailable
+    shared_memory = None
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
 
 ###############################################################################
 # Piece-Square tables. Tune these to change sunfish's behaviour
@@ -102,6 +116,34 @@ directions = {
     'K': (N, E, S, W, N+E, S+E, S+W, N+W)
 }
 
+
+def _ray(i, d, slide):
+    ray = []
+    j = i + d
+    while not initial[j].isspace():
+        ray.append(j)
+        if not slide:
+            break
+        j += d
+    return tuple(ray)
+
+
+# The moves of each piece from each square, computed once so move generation doesn't have to
+# find the edge of the board. rays[p][i] holds the target squares of piece p on square i, one
+# tuple per direction (of a single square for knights and kings). Pawns move by pawn_pushes[i],
+# their single and double step, and capture on pawn_captures[i]. The rooks castle along
+# castling_rays, from A1 and H1 towards the king.
+squares = tuple(i for i in range(120) if not initial[i].isspace())
+rays = dict((p, [()] * 120) for p in 'NBRQK')
+pawn_pushes, pawn_captures = [()] * 120, [()] * 120
+for _i in squares:
+    for _p in rays:
+        rays[_p][_i] = tuple(ray for ray in (_ray(_i, d, _p in 'BRQ') for d in directions[_p])
+                             if ray)
+    pawn_pushes[_i] = (_i + N, _i + 2*N) if A1 + N <= _i <= H1 + N else (_i + N,)
+    pawn_captures[_i] = _ray(_i, N+W, False) + _ray(_i, N+E, False)
+castling_rays = (_ray(A1, E, True), _ray(H1, W, True))
+
 # Mate value must be greater than 8*queen + 2*(rook+knight+bishop)
 # King value is set to twice this value such that if the opponent is
 # 8 queens up, but we got the king, we still exceed MATE_VALUE.
@@ -110,19 +152,130 @@ directions = {
 MATE_LOWER = piece['K'] - 10*piece['Q']
 MATE_UPPER = piece['K'] + 10*piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The memory budget of the transposition table in megabytes, and how it decides which entry
+# to keep when two positions share a slot (see TranspositionTable).
+TABLE_MB = 32
+TABLE_REPLACE = 'depth'
+
+# Zobrist keys. Every piece on every cell of the board gets a random 64 bit number, and the hash
+# of a position is the xor of the numbers of its pieces, castling rights and en passant squares.
+# The number for a piece is tied to that of its counterpart on the rotated board by swapping the
+# two 32 bit halves, so the hash of a rotated board is found without visiting its cells.
+MASK64 = (1 << 64) - 1
+swap_halves = lambda h: (h >> 32) | ((h << 32) & MASK64)
+_zobrist_random = random.Random(0x5f15)
+zobrist_pieces = {'.': (0,)*120}
+for k in 'PNBRQK':
+    zobrist_pieces[k] = tuple(_zobrist_random.getrandbits(64) for i in range(120))
+    zobrist_pieces[k.lower()] = tuple(swap_halves(zobrist_pieces[k][119-i]) for i in range(120))
+zobrist_castling = {(wc, bc): _zobrist_random.getrandbits(64)
+                    for wc in ((a, b) for a in (False, True) for b in (False, True))
+                    for bc in ((a, b) for a in (False, True) for b in (False, True))}
+zobrist_ep = (0,) + tuple(_zobrist_random.getrandbits(64) for i in range(119))
+zobrist_kp = (0,) + tuple(_zobrist_random.getrandbits(64) for i in range(119))
+# Keys mixing the search depth and root flag into the transposition table key of a position.
+# Iterative deepening stops before MAX_DEPTH, so every depth searched has a key.
+MAX_DEPTH = 1000
+zobrist_depth = tuple(_zobrist_random.getrandbits(64) for i in range(MAX_DEPTH + 1))
+zobrist_root = _zobrist_random.getrandbits(64)
+
+
+def zobrist(board, wc, bc, ep, kp):
+    """ Computes the hash of a position from scratch """
+    h = 0
+    for i, p in enumerate(board):
+        if p in zobrist_pieces:
+            h ^= zobrist_pieces[p][i]
+    return h ^ zobrist_castling[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+
+
+def rotate_hash(h, wc, bc, ep, kp):
+    """ Turns the hash of a position into that of the rotated position, where wc, bc, ep and
+    kp are the values of the unrotated position and ep and kp are kept """
+    h ^= zobrist_castling[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+    return (swap_halves(h) ^ zobrist_castling[bc, wc]
+            ^ zobrist_ep[119-ep if ep else 0] ^ zobrist_kp[119-kp if kp else 0])
 
 # Constants for tuning search
 QS_LIMIT = 150
 EVAL_ROUGHNESS = 20
+# Aspiration: each iteration of _search() looks for the score within ASPIRATION_WINDOW of the
+# score of the last iteration first, and widens the window ASPIRATION_GROWTH times when the
+# score turns out to be outside it
+ASPIRATION = True
+ASPIRATION_WINDOW = 40
+ASPIRATION_GROWTH = 4
+# Move ordering. Quiet moves causing a cutoff are remembered per ply in KILLER_SLOTS killer
+# slots, for the first KILLER_PLIES plies, and scored in the history table.
+KILLER_SLOTS = 2
+KILLER_PLIES = 64
+# Captures that lose material by static exchange evaluation (see()) are skipped in QS, and
+# searched after the quiet moves otherwise
+SEE_PRUNING = True
+# Selectivity in bound(), none of it applies at the root, in check or close to a mate score.
+# LMR: quiet moves after the first LMR_MOVES (and not killers) are searched LMR_REDUCTION plies
+# shallower from depth LMR_DEPTH on, and again at full depth if they fail high anyway.
+LMR = True
+LMR_DEPTH = 3
+LMR_MOVES = 3
+LMR_REDUCTION = 1
+# Futility: at depth d <= len(FUTILITY_MARGINS) a quiet move is not searched when even
+# FUTILITY_MARGINS[d-1] on top of its value can't reach gamma. At depth 1 the opponent's QS
+# can stand pat, so no margin is needed there.
+FUTILITY = True
+FUTILITY_MARGINS = (0, 200)
+# Reverse futility: at depth d <= REVERSE_FUTILITY_DEPTH the position fails high straight away
+# when its score is still at least gamma after giving up REVERSE_FUTILITY_MARGIN per ply.
+REVERSE_FUTILITY = True
+REVERSE_FUTILITY_DEPTH = 3
+REVERSE_FUTILITY_MARGIN = 120
+
+# Search with bound_stack(), which walks the tree with an explicit stack of node records, rather
+# than with the recursive bound(). Both search the same nodes in the same order.
+STACK_SEARCH = True
+
+# The games search chess.bitboard.BitboardPosition rather than the mailbox Position. It makes
+# moves faster, but generates them slower, and searches no faster overall yet
+BITBOARD_SEARCH = False
+
+# Before the MTD-bi search, Searcher.mate() looks for a forced mate in up to MATE_MOVES moves
+# among the checking moves only, giving up after MATE_NODES nodes, or after MATE_SHARE of the
+# nodes or seconds the search is given if that is less. It is only tried when the last search
+# of the Searcher scored at least MATE_GATE, or there was none: a side not that far ahead
+# two plies earlier seldom has a forced mate, and the search still finds those it reaches.
+MATE_SEARCH = True
+MATE_MOVES = 4
+MATE_NODES = 4000
+MATE_SHARE = 0.1
+MATE_GATE = 300
+
+# How often (in nodes) the search checks whether it has been told to stop or is out of time
+INTERRUPT_INTERVAL = 1024
+# An iteration can take much longer than the ones before it, so a search given secs is
+# interrupted at DEADLINE_FACTOR * secs during a game, even in the middle of an iteration.
+DEADLINE_FACTOR = 1.5
+# Pondering, i.e. searching on the opponent's time, stops at this depth. When the opponent plays
+# the move we pondered on, the reply is still searched for at least PONDER_HIT_SECS.
+PONDER_DEPTH = 30
+PONDER_HIT_SECS = 0.1
+
+# Number of processes searching in parallel (see ParallelSearcher), 1 searches in this process.
+# Helpers that haven't reported SMP_TIMEOUT seconds after being told to stop are ignored.
+SMP_WORKERS = 1
+SMP_TIMEOUT = 5
 
 
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+def piece_lists(board):
+    """ The squares of the pieces of the side to move, and of the opponent """
+    return (tuple(i for i, p in enumerate(board) if p.isupper()),
+            tuple(i for i, p in enumerate(board) if p.islower()))
+
+
+class Position(namedtuple('Position', 'board score wc bc ep kp hash pieces')):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -130,63 +283,146 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    hash - the 64 bit zobrist key of the position
+    pieces - the squares of our pieces and of the opponent's pieces, see piece_lists
     """
 
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
-        # as defined in the 'directions' map. The rays are broken e.g. by
-        # captures or immediately in case of pieces such as knights.
-        for i, p in enumerate(self.board):
-            if not p.isupper():
+        # as precomputed in the 'rays' tables. The rays are broken e.g. by
+        # captures, or end after one square in case of pieces such as knights.
+        board = self.board
+        for i in self.pieces[0]:
+            p = board[i]
+            if p == 'P':
+                # Pawn move and double move, onto empty squares only
+                for j in pawn_pushes[i]:
+                    if board[j] != '.':
+                        break
+                    yield (i, j)
+                # Pawn capture, also of the en passant and king passant squares
+                for j in pawn_captures[i]:
+                    if board[j].islower() or j == self.ep or j == self.kp:
+                        yield (i, j)
                 continue
-            for d in directions[p]:
-                for j in count(i+d, d):
-                    q = self.board[j]
-                    # Stay inside the board, and off friendly pieces
-                    if q.isspace() or q.isupper():
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = board[j]
+                    # Stay off friendly pieces
+                    if q.isupper():
+                        break
+                    # Move it
+                    yield (i, j)
+                    # Stop sliding after captures
+                    if q != '.':
                         break
-                    # Pawn move, double move and capture
-                    if p == 'P' and d in (N, N+N) and q != '.':
+        # Castling, when a rook could slide next to the king
+        if self.wc[0] and board[A1] == 'R':
+            for j in castling_rays[0]:
+                if board[j] != '.':
+                    if board[j] == 'K' and j > A1+E:
+                        yield (j, j+W+W)
+                    break
+        if self.wc[1] and board[H1] == 'R':
+            for j in castling_rays[1]:
+                if board[j] != '.':
+                    if board[j] == 'K' and j < H1+W:
+                        yield (j, j+E+E)
+                    break
+
+    def gen_captures(self):
+        """ The moves of gen_moves() which Searcher.moves() counts as captures: captures,
+        promotions, and moves onto or next to the king passant square. QS only needs these. """
+        board, kp = self.board, self.kp
+        for i in self.pieces[0]:
+            p = board[i]
+            if p == 'P':
+                if A8 <= i+N <= H8 and board[i+N] == '.':
+                    yield (i, i+N)
+                for j in pawn_captures[i]:
+                    if board[j].islower() or j == self.ep or j == kp:
+                        yield (i, j)
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = board[j]
+                    if q.isupper():
                         break
-                    if p == 'P' and d == N+N and (i < A1+N or self.board[i+N] != '.'):
+                    if q != '.' or abs(j - kp) < 2:
+                        yield (i, j)
+                    if q != '.':
                         break
-                    if p == 'P' and d in (N+W, N+E) and q == '.' and j not in (self.ep, self.kp):
+
+    def gen_quiets(self):
+        """ The moves of gen_moves() which gen_captures() leaves out, in the same order. The
+        search only generates them when no capture or killer move has cut it off. """
+        board, kp = self.board, self.kp
+        for i in self.pieces[0]:
+            p = board[i]
+            if p == 'P':
+                for j in pawn_pushes[i]:
+                    if board[j] != '.' or A8 <= j <= H8:
                         break
-                    # Move it
                     yield (i, j)
-                    # Stop crawlers from sliding, and sliding after captures
-                    if p in 'PNK' or q.islower():
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    if board[j] != '.':
                         break
-                    # Castling, by sliding the rook next to the king
-                    if i == A1 and self.board[j+E] == 'K' and self.wc[0]:
-                        yield (j+E, j+W)
-                    if i == H1 and self.board[j+W] == 'K' and self.wc[1]:
-                        yield (j+W, j+E)
+                    if abs(j - kp) >= 2:
+                        yield (i, j)
+        if self.wc[0] and board[A1] == 'R':
+            for j in castling_rays[0]:
+                if board[j] != '.':
+                    if board[j] == 'K' and j > A1+E:
+                        yield (j, j+W+W)
+                    break
+        if self.wc[1] and board[H1] == 'R':
+            for j in castling_rays[1]:
+                if board[j] != '.':
+                    if board[j] == 'K' and j < H1+W:
+                        yield (j, j+E+E)
+                    break
 
     def rotate(self):
         """ Rotates the board, preserving enpassant """
+        ours, theirs = self.pieces
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            rotate_hash(self.hash, self.wc, self.bc, self.ep, self.kp),
+            (tuple(119-i for i in theirs), tuple(119-i for i in ours)))
 
     def nullmove(self):
         """ Like rotate, but clears ep and kp """
+        h = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        ours, theirs = self.pieces
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0)
+            self.bc, self.wc, 0, 0, rotate_hash(h, self.wc, self.bc, 0, 0),
+            (tuple(119-i for i in theirs), tuple(119-i for i in ours)))
 
     def move(self, move):
         i, j = move
         p, q = self.board[i], self.board[j]
         put = lambda board, i, p: board[:i] + p + board[i+1:]
+        # The hash is updated for every cell we put a piece on, see zobrist_pieces
+        z = zobrist_pieces
         # Copy variables and reset ep and kp
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
         score = self.score + self.value(move)
+        h = self.hash ^ zobrist_castling[wc, bc] ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        # The piece lists are updated along with the board
+        ours, theirs = list(self.pieces[0]), self.pieces[1]
         # Actual move
+        h ^= z[p][i] ^ z[p][j] ^ z[q][j]
         board = put(board, j, board[i])
         board = put(board, i, '.')
+        ours[ours.index(i)] = j
+        if q != '.':
+            theirs = tuple(s for s in theirs if s != j)
         # Castling rights, we move the rook or capture the opponent's
         if i == A1:
             wc = (False, wc[1])
@@ -201,41 +437,159 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
             wc = (False, False)
             if abs(j-i) == 2:
                 kp = (i+j)//2
+                h ^= z['R'][A1 if j < i else H1] ^ z['R'][kp]
                 board = put(board, A1 if j < i else H1, '.')
                 board = put(board, kp, 'R')
+                ours[ours.index(A1 if j < i else H1)] = kp
         # Pawn promotion, double move and en passant capture
         if p == 'P':
             if A8 <= j <= H8:
+                h ^= z['P'][j] ^ z['Q'][j]
                 board = put(board, j, 'Q')
             if j - i == 2*N:
                 ep = i + N
             if j - i in (N+W, N+E) and q == '.':
+                h ^= z[board[j+S]][j+S]
+                if board[j+S] != '.':
+                    theirs = tuple(s for s in theirs if s != j+S)
                 board = put(board, j+S, '.')
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate()
+        ep, kp = 119-ep if ep else 0, 119-kp if kp else 0
+        h = swap_halves(h) ^ zobrist_castling[bc, wc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+        return Position(board[::-1].swapcase(), -score, bc, wc, ep, kp, h,
+                        (tuple(119-s for s in theirs), tuple(119-s for s in ours)))
 
     def value(self, move):
         i, j = move
-        p, q = self.board[i], self.board[j]
-        # Actual move
-        score = pst[p][j] - pst[p][i]
-        # Capture
-        if q.islower():
-            score += pst[q.upper()][119-j]
-        # Castling check detection
-        if abs(j-self.kp) < 2:
-            score += pst['K'][119-j]
-        # Castling
-        if p == 'K' and abs(i-j) == 2:
-            score += pst['R'][(i+j)//2]
-            score -= pst['R'][A1 if j < i else H1]
-        # Special pawn stuff
-        if p == 'P':
-            if A8 <= j <= H8:
-                score += pst['Q'][j] - pst['P'][j]
-            if j == self.ep:
-                score += pst['P'][119-(j+S)]
-        return score
+        return move_value(self.board[i], self.board[j], i, j, self.ep, self.kp)
+
+
+def move_value(p, q, i, j, ep, kp):
+    """ The change of score by moving piece p from i to j, onto q, in a position with the en
+    passant square ep and king passant square kp. Position.value() for a board already read. """
+    # Actual move
+    score = pst[p][j] - pst[p][i]
+    # Capture
+    if q.islower():
+        score += pst[q.upper()][119-j]
+    # Castling check detection
+    if abs(j-kp) < 2:
+        score += pst['K'][119-j]
+    # Castling
+    if p == 'K' and abs(i-j) == 2:
+        score += pst['R'][(i+j)//2]
+        score -= pst['R'][A1 if j < i else H1]
+    # Special pawn stuff
+    if p == 'P':
+        if A8 <= j <= H8:
+            score += pst['Q'][j] - pst['P'][j]
+        if j == ep:
+            score += pst['P'][119-(j+S)]
+    return score
+
+
+def _least_valuable_attacker(board, j, pieces, gone):
+    """ The square of the least valuable of pieces (either 'PNBRQK' or 'pnbrqk') attacking j,
+    or None. Squares in gone are taken as empty. """
+    pawn, knight, bishop, rook, queen, king = pieces
+    # Our pawns capture towards N, so they attack from the south, and theirs from the north
+    for a in ((j+S+W, j+S+E) if pawn == 'P' else (j+N+W, j+N+E)):
+        if board[a] == pawn and a not in gone:
+            return a
+    for (a,) in rays['N'][j]:
+        if board[a] == knight and a not in gone:
+            return a
+    # The first piece on each ray may attack along it
+    found = {}
+    for p, sliders in (('B', (bishop, queen)), ('R', (rook, queen))):
+        for ray in rays[p][j]:
+            for a in ray:
+                q = board[a]
+                if q == '.' or a in gone:
+                    continue
+                if q in sliders:
+                    found.setdefault(q, a)
+                break
+    for p in (bishop, rook, queen):
+        if p in found:
+            return found[p]
+    for (a,) in rays['K'][j]:
+        if board[a] == king and a not in gone:
+            return a
+    return None
+
+
+def see(pos, move):
+    """ Static exchange evaluation. The material won by move if both sides keep capturing on
+    its target square with their least valuable piece, as long as that pays off for them. """
+    board = pos.board
+    i, j = move
+    attacker = board[i]
+    gone = {i}
+    if board[j] != '.':
+        gain = [piece[board[j].upper()]]
+    elif attacker == 'P' and j == pos.ep:
+        gain = [piece['P']]
+        gone.add(j+S)
+    else:
+        gain = [0]
+    on_square = piece[attacker]
+    if attacker == 'P' and A8 <= j <= H8:
+        gain[0] += piece['Q'] - piece['P']
+        on_square = piece['Q']
+    sides = ('pnbrqk', 'PNBRQK')
+    while True:
+        a = _least_valuable_attacker(board, j, sides[(len(gain) + 1) % 2], gone)
+        if a is None:
+            break
+        # The score of the side capturing, seen from that side, if the exchange ends here
+        gain.append(on_square - gain[-1])
+        gone.add(a)
+        on_square = piece[board[a].upper()]
+    # Either side may stop capturing when that is better for them
+    while len(gain) > 1:
+        last = gain.pop()
+        gain[-1] = -max(-gain[-1], last)
+    return gain[0]
+
+
+def is_check(pos):
+    """ Whether the king of the side to move is attacked """
+    return _least_valuable_attacker(pos.board, pos.board.index('K'), 'pnbrqk', set()) is not None
+
+
+def is_quiet_move(pos, move):
+    """ Whether move is one of pos.gen_quiets(), found on the board without generating them.
+    Killer moves come from other positions, so they are checked with this before being
+    searched. """
+    board = pos.board
+    i, j = move
+    p = board[i]
+    if not p.isupper() or board[j] != '.' or abs(j - pos.kp) < 2:
+        return False
+    if p == 'P':
+        for k in pawn_pushes[i]:
+            if board[k] != '.' or A8 <= k <= H8:
+                return False
+            if k == j:
+                return True
+        return False
+    if p == 'K' and abs(j - i) == 2:
+        return move in pos.gen_quiets()
+    for ray in rays[p][i]:
+        for k in ray:
+            if k == j:
+                return True
+            if board[k] != '.':
+                break
+    return False
+
+
+def can_take_king(pos):
+    """ Whether the side to move can capture the opponent's king, i.e. the last move was
+    illegal """
+    j = pos.board.find('k')
+    return j < 0 or _least_valuable_attacker(pos.board, j, 'PNBRQK', set()) is not None
 
 
 ###############################################################################
@@ -244,49 +598,290 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
 
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
+UNKNOWN = Entry(-MATE_UPPER, MATE_UPPER)
 
 
-# The normal OrderedDict doesn't update the position of a key in the list,
-# when the value is changed.
-class LRUCache:
-    """Store items in the order the keys were last added"""
-    def __init__(self, size):
-        self.od = OrderedDict()
-        self.size = size
+# Typecode of an unsigned 64 bit array item. Python 2 has no 'Q', but there 'L' is 64 bits
+# wide on the platforms we run on.
+try:
+    _U64 = array('Q').typecode
+except ValueError:
+    _U64 = 'L'
 
-    def get(self, key, default=None):
-        try:
-            self.od.move_to_end(key)
-        except KeyError:
+
+class TranspositionTable:
+    """ A hash table of fixed size, held in preallocated arrays so memory use never grows.
+
+    Every slot holds a 64 bit key, the lower and upper bound of a score, a move packed as
+    i*120+j (0 meaning no move), the search depth and the search generation it was written in.
+    A key maps to exactly one slot, so two keys may compete for it:
+    replace -- 'depth' keeps the deeper entry unless the stored one is left over from an earlier
+               search, 'always' keeps the newest entry.
+    The table counts probes, hits, collisions (the slot held another key) and stores.
+
+    If buffer is given, e.g. the buffer of a ``multiprocessing.shared_memory`` block of
+    ``nbytes(megabytes)`` bytes, the slots live in it instead, so that processes can share the
+    table. The current generation is kept in the last byte of the buffer, so every process
+    writes and judges entries by the same one. Writes to a shared table are not locked, so a slot may be read half written.
+    """
+    SLOT_BYTES = 8 + 4 + 4 + 2 + 2 + 1
+    COLUMNS = (('keys', _U64, 8), ('lower', 'i', 4), ('upper', 'i', 4), ('moves', 'H', 2),
+               ('depths', 'h', 2), ('ages', 'B', 1))
+
+    def __init__(self, megabytes=None, replace=None, buffer=None):
+        # The defaults are read here, so a change to the constants takes effect
+        megabytes = TABLE_MB if megabytes is None else megabytes
+        replace = TABLE_REPLACE if replace is None else replace
+        if replace not in ('depth', 'always'):
+            raise ValueError("Unknown replacement scheme: %s" % replace)
+        slots = self.slots(megabytes)
+        self.size = slots
+        self.mask = slots - 1
+        self.replace = replace
+        self.shared = buffer is not None
+        offset = 0
+        for name, typecode, width in self.COLUMNS:
+            if self.shared:
+                column = memoryview(buffer)[offset:offset + width*slots].cast(typecode)
+            else:
+                column = array(typecode, [0]) * slots
+            setattr(self, name, column)
+            offset += width*slots
+        # A single item, shared along with the slots
+        if self.shared:
+            self.age = memoryview(buffer)[offset:offset + 1].cast('B')
+        else:
+            self.age = array('B', [0])
+        self.used = 0
+        self.probes = self.hits = self.collisions = self.stores = 0
+
+    @classmethod
+    def slots(cls, megabytes):
+        """ The number of slots of a table, the largest power of two within the budget """
+        slots = 1
+        while 2 * slots * cls.SLOT_BYTES <= megabytes * 2**20:
+            slots *= 2
+        return slots
+
+    @classmethod
+    def nbytes(cls, megabytes):
+        return cls.slots(megabytes) * cls.SLOT_BYTES + 1
+
+    def release(self):
+        """ Lets go of a shared buffer, which can't be closed while the table points into it """
+        if self.shared:
+            for name, _, _ in self.COLUMNS:
+                getattr(self, name).release()
+            self.age.release()
+
+    def new_search(self):
+        """ Marks all stored entries as left over from an earlier search """
+        self.age[0] = (self.age[0] + 1) & 0xff
+
+    def _probe(self, key):
+        self.probes += 1
+        i = key & self.mask
+        stored = self.keys[i]
+        if stored == key:
+            self.hits += 1
+            return i
+        if stored:
+            self.collisions += 1
+        return -1
+
+    def _slot(self, key, depth):
+        """ Returns the slot to write key to, or -1 if the replacement scheme keeps the current
+        entry """
+        i = key & self.mask
+        stored = self.keys[i]
+        if stored != key:
+            if not stored:
+                self.used += 1
+            elif (self.replace == 'depth' and self.ages[i] == self.age[0]
+                    and self.depths[i] > depth):
+                return -1
+            self.keys[i] = key
+            self.moves[i] = 0
+            self.lower[i], self.upper[i] = -MATE_UPPER, MATE_UPPER
+        self.stores += 1
+        self.depths[i] = depth
+        self.ages[i] = self.age[0]
+        return i
+
+    def get_entry(self, key, default=None):
+        i = self._probe(key)
+        if i < 0:
             return default
-        return self.od[key]
+        return Entry(self.lower[i], self.upper[i])
 
-    def __setitem__(self, key, value):
-        try:
-            del self.od[key]
-        except KeyError:
-            if len(self.od) == self.size:
-                self.od.popitem(last=False)
-        self.od[key] = value
+    def store_entry(self, key, depth, entry):
+        i = self._slot(key, depth)
+        if i >= 0:
+            self.lower[i], self.upper[i] = entry
+
+    def get_move(self, key):
+        i = self._probe(key)
+        if i < 0 or not self.moves[i]:
+            return None
+        return divmod(self.moves[i], 120)
+
+    def store_move(self, key, depth, move):
+        i = self._slot(key, depth)
+        if i >= 0:
+            self.moves[i] = move[0] * 120 + move[1] if move else 0
+
+    def stats(self):
+        """ Returns the counters of the table, and which fraction of its slots is in use. The
+        counters only cover this process. Another process may fill a shared table, so there
+        the occupancy is estimated from the first thousand slots. """
+        used = self.used
+        if self.shared:
+            sample = min(self.size, 1000)
+            used = sum(1 for i in range(sample) if self.keys[i]) * self.size // sample
+        return {'size': self.size, 'used': used, 'occupancy': used / float(self.size),
+                'probes': self.probes, 'hits': self.hits, 'collisions': self.collisions,
+                'stores': self.stores}
+
+
+class SearchInterrupted(Exception):
+    """ Raised inside the search when it runs out of nodes or time, or when it is told to
+    stop by stop() or the interrupt callback of the Searcher """
+    pass
+
+
+class MateBudgetExceeded(Exception):
+    """ Raised inside mate() when it runs out of its own nodes or time """
+    pass
+
+
+# Stages of a node in bound_stack(), in the order the moves of bound() are searched after the
+# null move
+S_TABLE, S_GENERATE, S_CAPTURES, S_KILLERS, S_QUIETS, S_LOSING, S_DONE = range(7)
+# What the child searched last by a node in bound_stack() was
+C_NULL, C_MOVE, C_REDUCED = range(3)
+
+
+class Node(object):
+    """ The state of one call of bound() in bound_stack(). The records are allocated once and
+    reused for every node at their ply. """
+    __slots__ = ('pos', 'gamma', 'depth', 'root', 'ply', 'key', 'entry', 'selective', 'best',
+                 'searched', 'stage', 'child', 'move', 'killer', 'killers', 'n', 'moves', 'index',
+                 'losing')
 
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = LRUCache(TABLE_SIZE)
-        self.tp_move = LRUCache(TABLE_SIZE)
+    def __init__(self, table_mb=None, replace=None, table=None, endgames=None):
+        self.tp = table if table is not None else TranspositionTable(table_mb, replace)
+        # chess.endgame.EndgameTables which answer the positions they hold without a search
+        self.endgames = endgames
         self.nodes = 0
-
-    def bound(self, pos, gamma, depth, root=True):
+        # The nodes searched in QS (depth 0), included in nodes
+        self.qs_nodes = 0
+        self.depth = 0
+        # Move ordering, see moves(). history is indexed by i*120+j of a move.
+        self.killers = [[None] * KILLER_SLOTS for _ in range(KILLER_PLIES)]
+        self.history = [0] * 120 * 120
+        # Nodes failing high on a move, and how many of those did on the first move searched
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+        # Null moves failing high, not included in cutoffs
+        self.null_cutoffs = 0
+        # The bound() calls made at the root by each iteration of the last search
+        self.bound_calls = {}
+        # The nodes searched by the last mate search, see mate()
+        self.mate_nodes = 0
+        # The record of the last search, see search()
+        self.last_search = None
+        # Limits checked during the search, see SearchInterrupted. interrupt is a callable
+        # polled every INTERRUPT_INTERVAL nodes, deadline a time.time() and max_nodes a count.
+        self.interrupt = None
+        self.deadline = None
+        self.max_nodes = None
+        self.stopped = False
+        # The node count at which the limits are checked next
+        self.next_check = sys.maxsize
+        # Node records of bound_stack(), one per ply, grown as needed
+        self.stack = [Node() for _ in range(KILLER_PLIES)]
+
+    def stop(self):
+        """ Ends the running search, e.g. from another thread. search() returns the best move
+        found so far. """
+        self.stopped = True
+        self.next_check = 0
+
+    def _check_limits(self):
+        if (self.stopped or (self.max_nodes is not None and self.nodes >= self.max_nodes)
+                or (self.deadline is not None and time.time() >= self.deadline)
+                or (self.interrupt is not None and self.interrupt())):
+            raise SearchInterrupted
+        self.next_check = self.nodes + INTERRUPT_INTERVAL
+        if self.max_nodes is not None:
+            self.next_check = min(self.next_check, self.max_nodes)
+
+    def cutoff_rate(self):
+        """ The fraction of cutoffs caused by the first move searched, a measure of how well
+        the moves are ordered """
+        return self.first_cutoffs / float(max(self.cutoffs, 1))
+
+    def moves(self, pos, depth, ply, skip):
+        """ Yields the moves of pos in the order they should be searched, skipping the move
+        skip (the table move, searched before):
+            captures, promotions and king captures, most valuable victim first and least
+            valuable attacker second (MVV-LVA),
+            the killer moves of this ply,
+            the other quiet moves, by their history score,
+            the captures losing material by static exchange evaluation.
+        The generation is staged: the quiet moves are only generated, and sorted, once the
+        captures and killers have been searched without a cutoff. In QS (depth 0) only the
+        captures worth at least QS_LIMIT, and not losing material, are searched. """
+        board, ep, kp = pos.board, pos.ep, pos.kp
+        captures, losing = [], []
+        for move in pos.gen_captures():
+            i, j = move
+            q = board[j]
+            if q != '.' or abs(j - kp) < 2:
+                captures.append((piece[q.upper()] if q != '.' else piece['K'],
+                                 -piece[board[i]], move))
+            else:
+                captures.append((piece['P'] if j == ep else piece['Q'], -piece['P'], move))
+        captures.sort(reverse=True)
+        for victim, attacker, move in captures:
+            if move == skip or depth == 0 and pos.value(move) < QS_LIMIT:
+                continue
+            # Only a capture of a cheaper piece can lose material, and never one of the king
+            if SEE_PRUNING and victim < -attacker and victim != piece['K'] and see(pos, move) < 0:
+                losing.append(move)
+                continue
+            yield move
+        if depth == 0:
+            return
+        killers = self.killers[ply] if ply < KILLER_PLIES else ()
+        for move in killers:
+            if move is not None and move != skip and is_quiet_move(pos, move):
+                yield move
+        history = self.history
+        quiets = [move for move in pos.gen_quiets() if move != skip and move not in killers]
+        quiets.sort(key=lambda move: history[move[0]*120 + move[1]], reverse=True)
+        for move in quiets:
+            yield move
+        for move in losing:
+            yield move
+
+    def bound(self, pos, gamma, depth, root=True, ply=0):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)
         """
         self.nodes += 1
+        if self.nodes >= self.next_check:
+            self._check_limits()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is
         # needed for calmness, and so there is no reason to keep different depths
         # in the transposition table.
         depth = max(depth, 0)
+        if depth == 0:
+            self.qs_nodes += 1
 
         # Sunfish is a king-capture engine, so we should always check if we
         # still have a king. Notice since this is the only termination check,
@@ -298,8 +893,9 @@ class Searcher:
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
+        key = pos.hash ^ zobrist_depth[depth] ^ (zobrist_root if root else 0)
+        entry = self.tp.get_entry(key, Entry(-MATE_UPPER, MATE_UPPER))
+        if entry.lower >= gamma and (not root or self.tp.get_move(pos.hash) is not None):
             return entry.lower
         if entry.upper < gamma:
             return entry.upper
@@ -307,12 +903,24 @@ class Searcher:
         # Here extensions may be added
         # Such as 'if in_check: depth += 1'
 
+        # Pruning is only safe where we are not in check, and no mate score is at stake
+        selective = (depth > 0 and not root and -MATE_LOWER < gamma < MATE_LOWER
+                     and (LMR or FUTILITY or REVERSE_FUTILITY) and not is_check(pos))
+        if (REVERSE_FUTILITY and selective and depth <= REVERSE_FUTILITY_DEPTH
+                and pos.score - REVERSE_FUTILITY_MARGIN * depth >= gamma):
+            return pos.score - REVERSE_FUTILITY_MARGIN * depth
+
+        def is_quiet(move):
+            i, j = move
+            return (pos.board[j] == '.' and abs(j - pos.kp) >= 2
+                    and not (pos.board[i] == 'P' and (j == pos.ep or A8 <= j <= H8)))
+
         # Generator of moves to search in order.
         # This allows us to define the moves, but only calculate them if needed.
         def moves():
             # First try not moving at all
             if depth > 0 and not root and any(c in pos.board for c in 'RBNQ'):
-                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False)
+                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False, ply=ply+1)
             # For QSearch we have a different kind of null-move
             if depth == 0:
                 yield None, pos.score
@@ -320,21 +928,54 @@ class Searcher:
             # Note, we don't have to check for legality, since we've already done it before.
             # Also note that in QS the killer must be a capture, otherwise we will be
             # non deterministic.
-            killer = self.tp_move.get(pos)
+            killer = self.tp.get_move(pos.hash)
+            # A table shared with other processes may hand us a half written entry, so make sure
+            # the killer moves one of our pieces, and not onto another.
+            if killer and (not pos.board[killer[0]].isupper() or pos.board[killer[1]].isupper()):
+                killer = None
             if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
+                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False,
+                                          ply=ply+1)
             # Then all the other moves
-            for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+            killers = self.killers[ply] if ply < KILLER_PLIES else ()
+            for n, move in enumerate(self.moves(pos, depth, ply, killer)):
+                if selective and is_quiet(move):
+                    if FUTILITY and depth <= len(FUTILITY_MARGINS):
+                        estimate = pos.score + pos.value(move) + FUTILITY_MARGINS[depth-1]
+                        if estimate < gamma:
+                            # The move fails low, and scores no more than estimate
+                            yield None, estimate
+                            continue
+                    if (LMR and depth >= LMR_DEPTH and n >= LMR_MOVES
+                            and move not in killers):
+                        score = -self.bound(pos.move(move), 1-gamma, depth-1-LMR_REDUCTION,
+                                            root=False, ply=ply+1)
+                        if score < gamma:
+                            yield move, score
+                            continue
+                yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False, ply=ply+1)
 
         # Run through the moves, shortcutting when possible
         best = -MATE_UPPER
+        searched = 0
         for move, score in moves():
+            if move is not None:
+                searched += 1
             best = max(best, score)
             if best >= gamma:
                 # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                self.tp.store_move(pos.hash, depth, move)
+                if move is not None:
+                    self.cutoffs += 1
+                    self.first_cutoffs += searched == 1
+                    # Remember quiet moves, captures are ordered well enough by MVV-LVA
+                    if depth > 0 and pos.board[move[1]] == '.' and abs(move[1] - pos.kp) >= 2:
+                        self.history[move[0]*120 + move[1]] += depth * depth
+                        if ply < KILLER_PLIES and move != self.killers[ply][0]:
+                            self.killers[ply] = [move] + self.killers[ply][:-1]
+                elif depth > 0:
+                    # Futility pruned moves score below gamma, so it was the null move
+                    self.null_cutoffs += 1
                 break
 
         # Stalemate checking is a bit tricky: Say we failed low, because
@@ -355,49 +996,608 @@ class Searcher:
 
         # Table part 2
         if best >= gamma:
-            self.tp_score[(pos, depth, root)] = Entry(best, entry.upper)
+            self.tp.store_entry(key, depth, Entry(best, entry.upper))
         if best < gamma:
-            self.tp_score[(pos, depth, root)] = Entry(entry.lower, best)
+            self.tp.store_entry(key, depth, Entry(entry.lower, best))
 
         return best
 
+    def bound_stack(self, pos, gamma, depth):
+        """ The same as bound(pos, gamma, depth) at the root, but without recursion. Each call
+        of bound() is a Node record on an explicit stack, and the moves() generator of bound()
+        and the one of Searcher.moves() become the stages of the node. This saves the frames,
+        generators and closures bound() creates at every node. """
+        stack, tp, history, killer_table = self.stack, self.tp, self.history, self.killers
+        sp = 0
+        node = stack[0]
+        node.pos, node.gamma, node.depth, node.root, node.ply = pos, gamma, depth, True, 0
+        # The result of the node which just returned, None when a node has just been entered
+        value = None
+        while True:
+            node = stack[sp]
+            pos, gamma, depth, ply = node.pos, node.gamma, node.depth, node.ply
+            push = None
+            if value is None:
+                # Entering the node, as at the start of bound()
+                self.nodes += 1
+                if self.nodes >= self.next_check:
+                    self._check_limits()
+                if depth < 0:
+                    depth = node.depth = 0
+                if depth == 0:
+                    self.qs_nodes += 1
+                root = node.root
+                if pos.score <= -MATE_LOWER:
+                    value = -MATE_UPPER
+                else:
+                    key = pos.hash ^ zobrist_depth[depth] ^ (zobrist_root if root else 0)
+                    entry = tp.get_entry(key, UNKNOWN)
+                    if entry.lower >= gamma and (not root or tp.get_move(pos.hash) is not None):
+                        value = entry.lower
+                    elif entry.upper < gamma:
+                        value = entry.upper
+                    else:
+                        selective = (depth > 0 and not root and -MATE_LOWER < gamma < MATE_LOWER
+                                     and (LMR or FUTILITY or REVERSE_FUTILITY)
+                                     and not is_check(pos))
+                        if (REVERSE_FUTILITY and selective and depth <= REVERSE_FUTILITY_DEPTH
+                                and pos.score - REVERSE_FUTILITY_MARGIN * depth >= gamma):
+                            value = pos.score - REVERSE_FUTILITY_MARGIN * depth
+                if value is not None:
+                    sp -= 1
+                    if sp < 0:
+                        return value
+                    continue
+                node.key, node.entry, node.selective = key, entry, selective
+                best = -MATE_UPPER
+                searched = index = n = 0
+                stage = S_TABLE
+                killer = moves = move = score = None
+                # First try not moving at all, or standing pat in QS
+                if depth > 0:
+                    if not root and any(c in pos.board for c in 'RBNQ'):
+                        push = C_NULL, None, pos.nullmove(), depth-3
+                else:
+                    score = pos.score
+            else:
+                # A child has returned
+                best = node.best
+                searched = node.searched
+                stage = node.stage
+                killer = node.killer
+                moves = node.moves
+                index = node.index
+                n = node.n
+                selective = node.selective
+                score = -value
+                value = None
+                move = None if node.child == C_NULL else node.move
+                if node.child == C_REDUCED and score >= gamma:
+                    # The reduced search failed high, search the move again at full depth
+                    push = C_MOVE, move, pos.move(move), depth-1
+
+            # Run through the moves, as the loop of bound() does, until a child is to be
+            # searched or the node is done
+            while push is None:
+                if score is not None:
+                    if move is not None:
+                        searched += 1
+                    if score > best:
+                        best = score
+                    if best >= gamma:
+                        tp.store_move(pos.hash, depth, move)
+                        if move is not None:
+                            self.cutoffs += 1
+                            self.first_cutoffs += searched == 1
+                            if (depth > 0 and pos.board[move[1]] == '.'
+                                    and abs(move[1] - pos.kp) >= 2):
+                                history[move[0]*120 + move[1]] += depth * depth
+                                if ply < KILLER_PLIES and move != killer_table[ply][0]:
+                                    killer_table[ply] = [move] + killer_table[ply][:-1]
+                        elif depth > 0:
+                            self.null_cutoffs += 1
+                        break
+                    score = None
+
+                # The next move of Searcher.moves()
+                if stage == S_CAPTURES:
+                    move = None
+                    while index < len(moves):
+                        victim, attacker, move = moves[index]
+                        index += 1
+                        if move == killer or depth == 0 and pos.value(move) < QS_LIMIT:
+                            move = None
+                        elif (SEE_PRUNING and victim < -attacker and victim != piece['K']
+                                and see(pos, move) < 0):
+                            if depth:
+                                node.losing.append(move)
+                            move = None
+                        else:
+                            break
+                    if move is None:
+                        if depth == 0:
+                            stage = S_DONE
+                        else:
+                            stage, moves, index = S_KILLERS, [
+                                move for move in node.killers if move is not None
+                                and move != killer and is_quiet_move(pos, move)
+                            ], 0
+                        continue
+                elif S_KILLERS <= stage < S_DONE:
+                    if index == len(moves):
+                        if stage == S_KILLERS:
+                            # The quiet moves are generated after the killers have been
+                            # searched, and sorted then since those change the history scores
+                            killers = node.killers
+                            quiets = [m for m in pos.gen_quiets()
+                                      if m != killer and m not in killers]
+                            quiets.sort(key=lambda move: history[move[0]*120 + move[1]],
+                                        reverse=True)
+                            stage, moves = S_QUIETS, quiets
+                        elif stage == S_QUIETS:
+                            stage, moves = S_LOSING, node.losing
+                        else:
+                            stage = S_DONE
+                        index = 0
+                        continue
+                    move = moves[index]
+                    index += 1
+                else:
+                    # The table move, and the moves of Searcher.moves() generated
+                    if stage == S_TABLE:
+                        stage = S_GENERATE
+                        killer = tp.get_move(pos.hash)
+                        if killer and (not pos.board[killer[0]].isupper()
+                                       or pos.board[killer[1]].isupper()):
+                            killer = None
+                        if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
+                            push = C_MOVE, killer, pos.move(killer), depth-1
+                    elif stage == S_GENERATE:
+                        board, ep, kp = pos.board, pos.ep, pos.kp
+                        captures = []
+                        for move in pos.gen_captures():
+                            i, j = move
+                            q = board[j]
+                            if q != '.' or abs(j - kp) < 2:
+                                captures.append((piece[q.upper()] if q != '.' else piece['K'],
+                                                 -piece[board[i]], move))
+                            else:
+                                captures.append((piece['P'] if j == ep else piece['Q'],
+                                                 -piece['P'], move))
+                        captures.sort(reverse=True)
+                        if depth:
+                            node.losing = []
+                            node.killers = killer_table[ply] if ply < KILLER_PLIES else ()
+                        stage = S_CAPTURES
+                        moves = captures
+                        index = 0
+                    else:
+                        break
+                    continue
+
+                # As the loop over Searcher.moves() in bound()
+                i, j = move
+                if selective and pos.board[j] == '.' and abs(j - pos.kp) >= 2 and not (
+                        pos.board[i] == 'P' and (j == pos.ep or A8 <= j <= H8)):
+                    if FUTILITY and depth <= len(FUTILITY_MARGINS):
+                        estimate = pos.score + pos.value(move) + FUTILITY_MARGINS[depth-1]
+                        if estimate < gamma:
+                            n += 1
+                            move, score = None, estimate
+                            continue
+                    if LMR and depth >= LMR_DEPTH and n >= LMR_MOVES and move not in node.killers:
+                        n += 1
+                        push = C_REDUCED, move, pos.move(move), depth-1-LMR_REDUCTION
+                        continue
+                n += 1
+                push = C_MOVE, move, pos.move(move), depth-1
+
+            if push is not None:
+                node.best = best
+                node.searched = searched
+                node.stage = stage
+                node.killer = killer
+                node.moves = moves
+                node.index = index
+                node.n = n
+                node.child, node.move, child_pos, child_depth = push
+                sp += 1
+                if sp == len(stack):
+                    stack.append(Node())
+                child = stack[sp]
+                child.pos = child_pos
+                child.gamma = 1-gamma
+                child.depth = child_depth
+                child.root = False
+                child.ply = ply+1
+                continue
+
+            # The node is done, as at the end of bound()
+            if best < gamma and best < 0 < depth:
+                is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
+                if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
+                    in_check = is_dead(pos.nullmove())
+                    best = -MATE_UPPER if in_check else 0
+            entry = node.entry
+            if best >= gamma:
+                tp.store_entry(node.key, depth, Entry(best, entry.upper))
+            if best < gamma:
+                tp.store_entry(node.key, depth, Entry(entry.lower, best))
+            # Let go of the positions and move lists of the node
+            node.pos = node.moves = node.losing = None
+            value = best
+            sp -= 1
+            if sp < 0:
+                return value
+
+    def mate(self, pos, moves=None, nodes=None, deadline=None):
+        """ Looks for a forced mate by the side to move in at most moves moves (MATE_MOVES),
+        trying only moves which give check. Returns the first move of the shortest mate found
+        and the number of moves to mate, or None when there is none or it takes more than
+        nodes nodes (MATE_NODES), or until the time.time() deadline, to find. """
+        moves = MATE_MOVES if moves is None else moves
+        nodes = MATE_NODES if nodes is None else nodes
+        self.mate_nodes = 0
+        # The positions after one of our checks that are known not to lead to mate within
+        # so many moves
+        refuted = {}
+        try:
+            for n in range(1, moves + 1):
+                move = self._mate(pos, n, nodes, deadline, refuted)
+                if move is not None:
+                    return move, n
+        except MateBudgetExceeded:
+            pass
+        return None
+
+    def _mate(self, pos, n, nodes, deadline, refuted):
+        """ The move of pos mating in at most n moves, or None. Raises MateBudgetExceeded
+        when out of nodes or time. """
+        for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
+            self.nodes += 1
+            self.mate_nodes += 1
+            if self.mate_nodes >= nodes or (deadline is not None and self.mate_nodes % 256 == 0
+                                            and time.time() >= deadline):
+                raise MateBudgetExceeded
+            if self.nodes >= self.next_check:
+                self._check_limits()
+            # Taking the king isn't a mate, and leaves no king to be in check. The position
+            # is illegal then, and left to the search.
+            if pos.value(move) >= MATE_LOWER:
+                continue
+            child = pos.move(move)
+            if can_take_king(child) or not is_check(child) or refuted.get(child.hash, 0) >= n:
+                continue
+            # Every legal reply must lead to mate. Without one, the opponent is mated already.
+            for reply in child.gen_moves():
+                after = child.move(reply)
+                if not can_take_king(after) and (
+                        n == 1 or self._mate(after, n - 1, nodes, deadline, refuted) is None):
+                    break
+            else:
+                return move
+            refuted[child.hash] = n
+        return None
+
     # secs over maxn is a breaking change. Can we do this?
     # I guess I could send a pull request to deep pink
     # Why include secs at all?
-    def _search(self, pos):
-        """ Iterative deepening MTD-bi search """
-        self.nodes = 0
+    def _search(self, pos, start=1):
+        """ Iterative deepening MTD-bi search, yielding (depth, move, score) after each
+        iteration. The node counts, and the generation of the table, go on from those of the
+        caller. """
+        self.cutoffs = self.first_cutoffs = self.null_cutoffs = 0
+        self.bound_calls = {}
+        # Keep what was learned about the moves in the last search, but let it fade
+        self.history = [h // 2 for h in self.history]
 
         # In finished games, we could potentially go far enough to cause a recursion
-        # limit exception. Hence we bound the ply.
-        for depth in range(1, 1000):
+        # limit exception, and run out of depth keys. Hence we bound the ply.
+        bound = self.bound_stack if STACK_SEARCH else self.bound
+        score = None
+        for depth in range(start, MAX_DEPTH):
             self.depth = depth
+            calls = 0
             # The inner loop is a binary search on the score of the position.
             # Inv: lower <= score <= upper
             # 'while lower != upper' would work, but play tests show a margin of 20 plays better.
             lower, upper = -MATE_UPPER, MATE_UPPER
+            # The binary search starts in a window around the last score, unless it was a mate
+            window = None
+            if ASPIRATION and score is not None and -MATE_LOWER < score < MATE_LOWER:
+                window = ASPIRATION_WINDOW
             while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower+upper+1)//2
-                score = self.bound(pos, gamma, depth)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
+                low, high = lower, upper
+                if window is not None:
+                    low, high = max(lower, score - window), min(upper, score + window)
+                    if high - low <= EVAL_ROUGHNESS:
+                        # The score is outside the window, which failed on that side
+                        window *= ASPIRATION_GROWTH
+                        continue
+                gamma = (low+high+1)//2
+                result = bound(pos, gamma, depth)
+                calls += 1
+                if result >= gamma:
+                    lower = result
+                if result < gamma:
+                    upper = result
             # We want to make sure the move to play hasn't been kicked out of the table,
             # So we make another call that must always fail high and thus produce a move.
-            score = self.bound(pos, lower, depth)
-
-            # Yield so the user may inspect the search
-            yield
-
-    def search(self, pos, secs):
+            score = bound(pos, lower, depth)
+            self.bound_calls[depth] = calls + 1
+
+            # Yield so the user may inspect the search. If the game hasn't finished we can
+            # retrieve our move from the transposition table.
+            yield depth, self.tp.get_move(pos.hash), score
+
+    def search(self, pos, secs=None, nodes=None, depth=None, deadline=None, interrupt=None,
+               info=None):
+        """ Searches pos until the first of the given limits is reached, and returns the best
+        move found so far with its score.
+            secs       don't start another iteration once secs seconds have passed
+            nodes      stop after searching this many nodes
+            depth      stop after the iteration of this depth
+            deadline   the time.time() at which to stop, even in the middle of an iteration
+            interrupt  callable polled during the search, which stops it by returning True
+            info       callable given depth, move and score after each finished iteration
+        Without any limits the search runs until stop() is called, which also ends a search
+        about to start; the next search starts afresh. An interrupted iteration is thrown away,
+        and self.depth is the depth of the last finished one. The node limit counts the nodes
+        of mate() too. With a node limit, and no time limits, the result only depends on pos,
+        the contents of the table, and the killer and history tables left by earlier searches.
+        A position held by the endgame tables is answered from them, with a depth of 0, and
+        a forced mate found by mate() straight away, with the depth of the mate in plies.
+        The statistics of the search are kept in self.last_search, see _record(). """
         start = time.time()
-        for _ in self._search(pos):
-            if time.time() - start > secs:
+        counters = self.tp.probes, self.tp.hits, self.tp.stores
+        iterations = []
+        self.nodes = self.qs_nodes = self.mate_nodes = 0
+        self.cutoffs = self.first_cutoffs = self.null_cutoffs = 0
+        self.tp.new_search()
+        self.deadline, self.max_nodes = deadline, nodes
+        if interrupt is not None:
+            self.interrupt = interrupt
+        move, score, finished = None, 0, 0
+        last = self.last_search
+        try:
+            if self.endgames is not None:
+                found = self.endgames.best_move(pos)
+                if found is not None:
+                    self.depth = 0
+                    self._record(pos, 'endgame', found[0], found[1], start, counters,
+                                 iterations)
+                    if info is not None:
+                        info(0, found[0], found[1])
+                    return found
+            # The limits are checked at the first node, so a stop() made before is seen
+            self.next_check = 0
+            mate = None
+            if MATE_SEARCH and (last is None or last['score'] >= MATE_GATE):
+                # The mate search mustn't use up the budget of the search
+                mate_nodes = MATE_NODES if nodes is None else min(MATE_NODES,
+                                                                  int(MATE_SHARE * nodes))
+                mate_deadline = start + MATE_SHARE * secs if secs is not None else None
+                mate = self.mate(pos, nodes=mate_nodes, deadline=mate_deadline)
+            if mate is not None:
+                # Mating in n moves leaves the opponent mated after 2n-2 plies
+                move, n = mate
+                self.depth = 2*n - 1
+                self._record(pos, 'mate', move, MATE_UPPER - 2*(n - 1), start, counters,
+                             iterations)
+                if info is not None:
+                    info(self.depth, move, MATE_UPPER - 2*(n - 1))
+                return move, MATE_UPPER - 2*(n - 1)
+            for finished, move, score in self._search(pos):
+                iterations.append({'depth': finished, 'move': move, 'score': score,
+                                   'nodes': self.nodes, 'secs': time.time() - start,
+                                   'bound_calls': self.bound_calls[finished]})
+                if info is not None:
+                    info(finished, move, score)
+                if ((secs is not None and time.time() - start > secs)
+                        or (depth is not None and finished >= depth)):
+                    break
+        except SearchInterrupted:
+            pass
+        finally:
+            self.deadline = self.max_nodes = None
+            self.next_check = sys.maxsize
+            # A stop() ends the search it came during, or the next one, but no other
+            self.stopped = False
+            if interrupt is not None:
+                self.interrupt = None
+        self.depth = finished
+        legal = list(pos.gen_moves())
+        if move is None and legal:
+            # Not even the first iteration finished. Use what the table knows, or the move
+            # capturing the most.
+            move = self.tp.get_move(pos.hash)
+            if move not in legal:
+                move = max(legal, key=pos.value)
+            score = pos.score + pos.value(move)
+        self._record(pos, 'search', move, score, start, counters, iterations)
+        return move, score
+
+    def _record(self, pos, source, move, score, start, counters, iterations):
+        """ Keeps the statistics of the search of pos which started at start in
+        self.last_search, a dict of
+            source      'search', 'mate' (found by mate()) or 'endgame' (from the tables)
+            move, score, depth, pv
+                        the result, the depth of the last finished iteration, and the
+                        principal variation starting with move
+            secs, nodes, qs_nodes, mate_nodes, nps
+                        the time taken, the nodes searched (QS and mate() included), and
+                        those of QS and of mate()
+            iterations  a dict per finished iteration with its depth, move, score, and the
+                        nodes and seconds taken by the search up to its end
+            table       the probes, hits and stores of the transposition table
+            cutoffs, first_cutoffs, null_cutoffs
+                        the nodes failing high on a move, on the first one, and on the null move
+        The moves are those of the board of the side to move in pos, see render_search(). """
+        secs = time.time() - start
+        probes, hits, stores = counters
+        self.last_search = {
+            'source': source, 'move': move, 'score': score, 'depth': self.depth,
+            'pv': self.pv(pos, move, max(self.depth, 1)),
+            'secs': secs, 'nodes': self.nodes, 'qs_nodes': self.qs_nodes,
+            'mate_nodes': self.mate_nodes, 'nps': self.nodes / max(secs, 1e-6),
+            'iterations': iterations,
+            'table': {'probes': self.tp.probes - probes, 'hits': self.tp.hits - hits,
+                      'stores': self.tp.stores - stores},
+            'cutoffs': self.cutoffs, 'first_cutoffs': self.first_cutoffs,
+            'null_cutoffs': self.null_cutoffs}
+
+    def pv(self, pos, move, length):
+        """ The principal variation of pos starting with move, followed through the moves of
+        the transposition table: at most length moves, and no position twice. The reply to
+        move is always given if there is one, the move to ponder on, when the table lacks it
+        too: the one winning the most at once that doesn't leave the king to be taken. """
+        pv, seen = [], set()
+        while move is not None and len(pv) < length and pos.hash not in seen:
+            if move not in pos.gen_moves():
+                break
+            seen.add(pos.hash)
+            pv.append(move)
+            pos = pos.move(move)
+            move = self.tp.get_move(pos.hash)
+            if len(pv) == 1 and move not in pos.gen_moves():
+                replies = [m for m in pos.gen_moves() if not can_take_king(pos.move(m))]
+                move = max(replies, key=pos.value) if replies else None
+        return pv
+
+    def ponder(self, pos, interrupt):
+        """ Thinks on the opponent's time, who is to move in pos. We guess their move, and
+        search the position it leads to until interrupt() returns True, so the transposition
+        table is warm by the time we have to reply. Returns the guessed move, or None. """
+        # The best reply is usually in the table from our last search. If it has been
+        # replaced, a shallow search of the opponent's position finds a new one.
+        guess = self.tp.get_move(pos.hash)
+        if guess not in pos.gen_moves():
+            guess, _ = self.search(pos, depth=3, interrupt=interrupt)
+        if guess is not None and not interrupt():
+            self.search(pos.move(guess), depth=PONDER_DEPTH, interrupt=interrupt)
+        return guess
+
+
+def _helper(name, table_mb, replace, index, jobs, results, stop):
+    """ Runs in a helper process of the ParallelSearcher. Searches each position put on jobs
+    until stop is set, then reports its deepest finished iteration on results, tagged with the
+    id of the job. """
+    parent = os.getppid()
+    block = shared_memory.SharedMemory(name=name)
+    searcher = Searcher(table=TranspositionTable(table_mb, replace, buffer=block.buf))
+    searcher.interrupt = stop.is_set
+    while True:
+        try:
+            job = jobs.get(timeout=1)
+        except Empty:
+            # Don't outlive the process we are helping, it may have been terminated
+            if os.getppid() != parent:
                 break
-        # If the game hasn't finished we can retrieve our move from the
-        # transposition table.
-        return self.tp_move.get(pos), self.tp_score.get((pos, self.depth, True)).lower
+            continue
+        if job is None:
+            break
+        job_id, pos = job
+        result = 0, None, 0
+        searcher.nodes = searcher.qs_nodes = 0
+        searcher.next_check = 0
+        try:
+            # Half the helpers start a ply deeper, so they don't all search the same tree
+            for result in searcher._search(pos, start=1 + index % 2):
+                if stop.is_set():
+                    break
+        except SearchInterrupted:
+            pass
+        results.put((job_id,) + result + (searcher.nodes,))
+    searcher.tp.release()
+    block.close()
+
+
+class ParallelSearcher:
+    """ Lazy SMP. The position is searched by this process and by workers-1 helper processes
+    at once, all running the usual iterative deepening on one transposition table held in
+    shared memory. The table lets the processes pick up each other's results, and the deepest
+    finished iteration of any of them gives the move. Use it like a Searcher, and close() it
+    when done. """
+
+    def __init__(self, workers=SMP_WORKERS, table_mb=None, replace=None, endgames=None):
+        if shared_memory is None:
+            raise RuntimeError("Parallel search needs multiprocessing.shared_memory (Python 3.8+)")
+        table_mb = TABLE_MB if table_mb is None else table_mb
+        replace = TABLE_REPLACE if replace is None else replace
+        self.block = shared_memory.SharedMemory(create=True,
+                                                size=TranspositionTable.nbytes(table_mb))
+        self.searcher = Searcher(table=TranspositionTable(table_mb, replace,
+                                                          buffer=self.block.buf),
+                                 endgames=endgames)
+        self.tp = self.searcher.tp
+        self.nodes = 0
+        self.depth = 0
+        self.last_search = None
+        self.job_id = 0
+        self.stop_event = mp.Event()
+        self.results = mp.Queue()
+        self.jobs = []
+        self.helpers = []
+        for index in range(1, workers):
+            jobs = mp.Queue()
+            helper = mp.Process(target=_helper, args=(self.block.name, table_mb, replace, index,
+                                                      jobs, self.results, self.stop_event))
+            helper.daemon = True
+            helper.start()
+            self.jobs.append(jobs)
+            self.helpers.append(helper)
+
+    def search(self, pos, secs=None, nodes=None, depth=None, deadline=None, interrupt=None,
+               info=None):
+        """ Like Searcher.search. The limits apply to the search in this process, the helpers
+        are stopped when it ends, and info is given the iterations of this process. """
+        self.stop_event.clear()
+        self.job_id += 1
+        for jobs in self.jobs:
+            jobs.put((self.job_id, pos))
+        move, score = self.searcher.search(pos, secs, nodes, depth, deadline, interrupt, info)
+        self.stop_event.set()
+        # Our own result comes first, so it wins ties on depth
+        self.nodes = self.searcher.nodes
+        finished = [(self.searcher.depth, move, score)]
+        legal = set(pos.gen_moves())
+        pending = len(self.jobs)
+        while pending:
+            # A helper that died won't answer, don't wait for it forever
+            try:
+                job_id, depth, move, score, nodes = self.results.get(timeout=SMP_TIMEOUT)
+            except Empty:
+                break
+            if job_id != self.job_id:
+                continue  # Late answer to an earlier search
+            pending -= 1
+            self.nodes += nodes
+            if move in legal:
+                finished.append((depth, move, score))
+        self.depth, move, score = max(finished, key=lambda result: result[0])
+        # The statistics are those of this process, but for the result and the nodes
+        record = self.searcher.last_search
+        self.last_search = dict(record, move=move, score=score, depth=self.depth,
+                                pv=self.searcher.pv(pos, move, max(self.depth, 1)),
+                                nodes=self.nodes, nps=self.nodes / max(record['secs'], 1e-6),
+                                workers=len(self.helpers) + 1)
+        return move, score
+
+    def ponder(self, pos, interrupt):
+        return self.searcher.ponder(pos, interrupt)
+
+    def stop(self):
+        """ Ends the running search, like Searcher.stop """
+        self.searcher.stop()
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for helper in self.helpers:
+            helper.join()
+        self.tp.release()
+        self.block.close()
+        self.block.unlink()
 
 
 ###############################################################################
@@ -408,12 +1608,6 @@ class Searcher:
 if sys.version_info[0] == 2:
     input = raw_input
 
-    class NewOrderedDict(OrderedDict):
-        def move_to_end(self, key):
-            value = self.pop(key)
-            self[key] = value
-    OrderedDict = NewOrderedDict
-
 
 def parse(c):
     fil, rank = ord(c[0]) - ord('a'), int(c[1]) - 1
@@ -434,9 +1628,67 @@ def print_pos(pos):
     print('    a b c d e f g h \n\n')
 
 
-def main(command_queue, reply_queue, valid_queue):
-    pos = Position(initial, 0, (False, False), (False, False), 0, 0)  # TODO; Removed castling rule
-    searcher = Searcher()
+def render_search(record):
+    """ The record of a search by sunfish as black (see Searcher._record), with its moves
+    written as on the board, e.g. 'e7e5', so it can be stored as JSON """
+    def line(moves):
+        # Every other move is made on the rotated board of black
+        return [None if move is None else
+                render(119-move[0]) + render(119-move[1]) if ply % 2 == 0 else
+                render(move[0]) + render(move[1]) for ply, move in enumerate(moves)]
+    return dict(record, move=line([record['move']])[0], pv=line(record['pv']),
+                iterations=[dict(iteration, move=line([iteration['move']])[0])
+                            for iteration in record['iterations']])
+
+
+def replay(pos, moves):
+    """ Plays moves like 'e2e4' from pos, alternately for the side to move and the other side,
+    and returns the position reached """
+    for ply, move in enumerate(moves):
+        i, j = parse(move[0:2]), parse(move[2:4])
+        if ply % 2:  # The board is rotated for the other side
+            i, j = 119 - i, 119 - j
+        if (i, j) not in pos.gen_moves():
+            raise ValueError("Illegal move: %s" % move)
+        pos = pos.move((i, j))
+    return pos
+
+
+def main(channel, ponder=False, workers=SMP_WORKERS, cache=None, endgames=None):
+    # The bitboard position and the endgame tables build on this module, so they can only be
+    # imported once we're loaded
+    from chess.bitboard import initial_position
+    from chess.endgame import EndgameTables
+    pos = initial_position(castling=False)  # TODO; Removed castling rule
+    if not BITBOARD_SEARCH:
+        pos = pos.to_position()
+    endgames = EndgameTables(endgames) if endgames is not None else None
+    searcher = (ParallelSearcher(workers, endgames=endgames) if workers > 1
+                else Searcher(endgames=endgames))
+    if workers > 1:
+        # The engine terminates us when it exits, the shared table must be cleaned up then
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    cache = ReplyCache(cache) if cache is not None else None
+    try:
+        play(pos, searcher, channel, ponder, cache)
+    finally:
+        if workers > 1:
+            searcher.close()
+        if cache is not None:
+            cache.close()
+        if endgames is not None:
+            endgames.close()
+
+
+def play(pos, searcher, channel, ponder, cache=None):
+    """ Plays one game from pos, answering the requests of the engine on channel. The replies
+    found are stored in cache, a chess.cache.ReplyCache, if given. """
+    secs = 2
+    # The moves played so far. The engine sends its own list with each move, so we can tell
+    # when it has missed one of our answers.
+    start_pos, history = pos, []
+    # The move we pondered on during the user's turn, and when we started
+    ponder_move, ponder_start = None, None
     while True:
         print_pos(pos)
 
@@ -446,12 +1698,34 @@ def main(command_queue, reply_queue, valid_queue):
 
         # We query the user until she enters a (pseudo) legal move.
         move = None
-        pass_number = 1  # We set the first pass number before entering the loop
         while move not in pos.gen_moves():
-            if pass_number > 1:  # if on the second pass, the previous must've been invalid
-                valid_queue.put(0)  # report to engine that the input was invalid
+            if ponder and pos.score > -MATE_LOWER and not channel.poll():
+                # Think while the user does, until their request arrives
+                if ponder_start is None:
+                    ponder_start = time.time()
+                ponder_move = searcher.ponder(pos, channel.poll)
+
+            request = channel.recv()  # get a request from engine
+            if request.kind == PING:
+                channel.reply(request, None)
+                continue
+            if request.kind != MOVE:
+                channel.error(request, "Unknown request: %s" % request.kind)
+                continue
 
-            command = command_queue.get(block=True)  # get a command from engine if available
+            moves, command = request.payload
+            if list(moves) != history:
+                # The engine gave up waiting for one of our answers, so it doesn't know about
+                # the last moves we played. Continue from the game as the engine knows it.
+                print("Resynchronising with the engine")
+                try:
+                    if len(moves) % 2:
+                        raise ValueError("Not the user's turn after %d moves" % len(moves))
+                    pos, history = replay(start_pos, moves), list(moves)
+                except ValueError as e:
+                    channel.error(request, str(e))
+                    continue
+                ponder_move, ponder_start = None, None
 
             match = re.match('([a-h][1-8])'*2, command)
             if match:
@@ -460,9 +1734,12 @@ def main(command_queue, reply_queue, valid_queue):
                 # Inform the user when invalid input (e.g. "help") is entered
                 print("Please enter a move like g8f6")
 
-            pass_number += 1
+            if move not in pos.gen_moves():
+                # report to engine that the input was invalid
+                channel.reply(request, (0, None, None))
 
         pos = pos.move(move)
+        history.append(command)
 
         # After our move we rotate the board and print it again.
         # This allows us to see the effect of our move.
@@ -470,23 +1747,43 @@ def main(command_queue, reply_queue, valid_queue):
 
         if pos.score <= -MATE_LOWER:
             print("You won")
-            valid_queue.put(1)  # inform engine that the move was accepted and user won
+            channel.reply(request, (1, None, None))  # the move was accepted and user won
             break
 
-        # Fire up the engine to look for a move.
-        move, score = searcher.search(pos, secs=2)
-
-        if score == MATE_UPPER:
-            print("Checkmate!")
-            valid_queue.put(2)  # inform engine that the move was accepted and computer won
+        # Fire up the engine to look for a move. If the user played the move we pondered on,
+        # the table already holds most of the search and the time pondered counts as ours.
+        start = time.time()
+        ponder_hit = ponder_move is not None and move == ponder_move
+        if ponder_hit:
+            print("Ponder hit")
+            secs_left = max(PONDER_HIT_SECS, secs - (start - ponder_start))
         else:
-            valid_queue.put(3)  # inform engine that the move was accepted and sunfish will reply
+            secs_left = secs
+
+        def info(depth, best, score):
+            # Lets the engine follow the search, e.g. to get the arm moving early
+            if best is not None:
+                channel.inform(request, (depth, render(119-best[0]) + render(119-best[1]), score))
+        move, score = searcher.search(pos, secs=secs_left,
+                                      deadline=start + DEADLINE_FACTOR * secs_left, info=info)
+        ponder_move, ponder_start = None, None
+
         # The black player moves from a rotated position, so we have to
         # 'back rotate' the move before printing it.
         computer_move = render(119-move[0]) + render(119-move[1])
-        reply_queue.put(computer_move, block=True)  # reply to engine
+        if score == MATE_UPPER:
+            print("Checkmate!")
+            code = 2  # the move was accepted and computer won
+        else:
+            code = 3  # the move was accepted and sunfish replies
+        # The statistics of the search go with the reply, see Searcher._record
+        stats = dict(render_search(searcher.last_search), ponder_hit=ponder_hit)
+        channel.reply(request, (code, computer_move, stats))  # reply to engine
         print("My move:", computer_move)
+        if cache is not None:
+            cache.put(pos.hash, computer_move, score, searcher.depth)
         pos = pos.move(move)
+        history.append(computer_move)
 
 
 if __name__ == '__main__':
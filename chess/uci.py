@@ -0,0 +1,348 @@
+"""
+UCI (Universal Chess Interface) support for the custom sunfish engine.
+
+``python -m chess.uci`` runs the engine as a UCI engine on stdin and stdout, so it can be played
+and tested against other engines with the usual tournament tools. It understands ``uci``,
+``isready``, ``ucinewgame``, ``setoption name Hash``, ``position`` (``startpos`` or ``fen``, with
+``moves``), ``go`` with ``movetime``, ``nodes``, ``depth``, ``wtime``/``btime`` (with increments
+and ``movestogo``) or ``infinite``, ``stop`` and ``quit``, and prints an ``info`` line after each
+iteration of the search. Sunfish only promotes to queens, so other promotions are read as ones
+to a queen.
+
+``UCIEngine`` works the other way round: it drives any UCI engine binary, and answers the
+requests of ``chess.channel`` with its moves, so ``ChessEngine(uci='stockfish')`` plays with that
+engine rather than with Sunfish.
+"""
+from __future__ import print_function
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from chess.bitboard import from_fen, initial_position
+from chess.channel import MOVE, PING, ChannelError, ChannelTimeout, LatencyHistogram
+import chess.sunfish_custom as sunfish
+try:
+    from queue import Queue, Empty
+except ImportError:  # Python 2
+    from Queue import Queue, Empty
+
+ENGINE_NAME = 'Sunfish custom'
+ENGINE_AUTHOR = 'DE3-ROB1 chess team'
+# Moves a game is expected to last from any position, to divide the clock by
+UCI_MOVES_LEFT = 30
+# Search time per move of an engine driven by UCIEngine, in milliseconds
+UCI_MOVETIME = 2000
+# Seconds to wait for an engine to start, and for it to answer stop
+UCI_STARTUP_TIMEOUT = 10
+UCI_STOP_TIMEOUT = 5
+# The position games with the robot start from: Sunfish doesn't castle
+NO_CASTLING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w - - 0 1'
+
+
+def uci_move(pos, move):
+    """The UCI notation of a move (i, j) of pos, e.g. ``'e7e8q'``."""
+    i, j = move
+    promotion = 'q' if pos.board[i] == 'P' and sunfish.A8 <= j <= sunfish.H8 else ''
+    if pos.color:  # The board is rotated for the second player
+        i, j = 119 - i, 119 - j
+    return sunfish.render(i) + sunfish.render(j) + promotion
+
+
+def parse_move(pos, text):
+    """The move (i, j) of pos written text in UCI notation. Raises a ValueError if pos has no
+    such move."""
+    if not re.match('([a-h][1-8]){2}[qrbn]?$', text):
+        raise ValueError("Not a UCI move: %s" % text)
+    i, j = sunfish.parse(text[0:2]), sunfish.parse(text[2:4])
+    if pos.color:
+        i, j = 119 - i, 119 - j
+    if (i, j) not in pos.gen_moves():
+        raise ValueError("Illegal move: %s" % text)
+    return i, j
+
+
+def uci_score(score):
+    """The UCI notation of a score, in centipawns or in moves to mate."""
+    if score >= sunfish.MATE_LOWER:
+        return 'mate %d' % ((sunfish.MATE_UPPER - score) // 2 + 1)
+    if score <= -sunfish.MATE_LOWER:
+        return 'mate -%d' % ((sunfish.MATE_UPPER + score) // 2 + 1)
+    return 'cp %d' % score
+
+
+def parse_score(unit, value):
+    """The score of a UCI score in cp (centipawns) or mate (moves to mate) units."""
+    if unit == 'cp':
+        return value
+    if value > 0:
+        return sunfish.MATE_UPPER - 2 * (value - 1)
+    return -sunfish.MATE_UPPER + 2 * (-value - 1)
+
+
+###############################################################################
+# The engine as a UCI engine
+###############################################################################
+
+class UCI:
+    """Plays the engine over UCI, reading commands from input and writing to output. The
+    search runs in a thread of its own, so that ``stop`` and ``isready`` are answered while
+    it does."""
+    def __init__(self, output=sys.stdout, table_mb=sunfish.TABLE_MB):
+        self.output = output
+        self.table_mb = table_mb
+        self.searcher = sunfish.Searcher(table_mb)
+        self.pos = initial_position()
+        self.thread = None
+        # Set by stop(), which a search under go infinite waits for before its bestmove
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def send(self, line):
+        with self.lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def run(self, input=sys.stdin):
+        for line in iter(input.readline, ''):
+            try:
+                if not self.handle(line):
+                    break
+            except ValueError as e:
+                self.send('info string %s' % e)
+        self.stop()
+
+    def handle(self, line):
+        """Carries out one command. Returns False on ``quit``."""
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == 'uci':
+            self.send('id name %s' % ENGINE_NAME)
+            self.send('id author %s' % ENGINE_AUTHOR)
+            self.send('option name Hash type spin default %d min 1 max 4096' % self.table_mb)
+            self.send('uciok')
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'setoption':
+            match = re.match(r'name\s+hash\s+value\s+(\d+)$', ' '.join(args), re.IGNORECASE)
+            if match:
+                self.stop()
+                self.table_mb = int(match.group(1))
+                self.searcher = sunfish.Searcher(self.table_mb)
+        elif command == 'ucinewgame':
+            self.stop()
+            self.searcher = sunfish.Searcher(self.table_mb)
+        elif command == 'position':
+            self.stop()
+            self.position(args)
+        elif command == 'go':
+            self.stop()
+            self.go(args)
+        elif command == 'stop':
+            self.stop()
+        elif command == 'quit':
+            return False
+        return True
+
+    def position(self, args):
+        moves = args.index('moves') if 'moves' in args else len(args)
+        if args[:1] == ['startpos']:
+            pos = initial_position()
+        elif args[:1] == ['fen']:
+            pos = from_fen(' '.join(args[1:moves]))
+        else:
+            raise ValueError("Unknown position: %s" % ' '.join(args))
+        for text in args[moves + 1:]:
+            pos = pos.move(parse_move(pos, text))
+        self.pos = pos
+
+    def go(self, args):
+        """Starts searching the position with the limits of a ``go`` command."""
+        values = dict(zip(args, args[1:]))
+        limits = {}
+        start = time.time()
+        if 'movetime' in values:
+            secs = int(values['movetime']) / 1000.0
+            limits.update(secs=secs, deadline=start + secs)
+        clock, increment = ('btime', 'binc') if self.pos.color else ('wtime', 'winc')
+        if clock in values:
+            left = int(values[clock]) / 1000.0
+            secs = left / int(values.get('movestogo', UCI_MOVES_LEFT))
+            secs += int(values.get(increment, 0)) / 1000.0
+            # Never risk more than half the clock, even when the deadline is reached
+            secs = min(secs, left / (2 * sunfish.DEADLINE_FACTOR))
+            limits.update(secs=secs, deadline=start + sunfish.DEADLINE_FACTOR * secs)
+        if 'nodes' in values:
+            limits['nodes'] = int(values['nodes'])
+        if 'depth' in values:
+            limits['depth'] = int(values['depth'])
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._search,
+                                       args=(self.pos, start, limits, 'infinite' in args))
+        self.thread.start()
+
+    def _search(self, pos, start, limits, infinite=False):
+        def info(depth, move, score):
+            secs = time.time() - start
+            pv = ' '.join(uci_move(p, m) for p, m in self._pv_positions(pos, move, depth))
+            self.send('info depth %d score %s nodes %d nps %d time %d pv %s'
+                      % (depth, uci_score(score), self.searcher.nodes,
+                         self.searcher.nodes / max(secs, 0.001), secs * 1000, pv))
+        move = None
+        try:
+            # The search gets the mailbox Position, unless told otherwise; pos knows whose move
+            # it is, for writing the moves
+            searched = pos if sunfish.BITBOARD_SEARCH else pos.to_position()
+            move, _ = self.searcher.search(searched, info=info, interrupt=self.stopping.is_set,
+                                           **limits)
+        finally:
+            # A bestmove is owed whatever happens, or the GUI waits for it forever
+            legal = list(pos.legal_moves())
+            if move not in legal:
+                move = max(legal, key=pos.value) if legal else None
+            if infinite:
+                # The search may end by itself, e.g. in a decided position, but under go
+                # infinite the move is only sent once told to stop
+                self.stopping.wait()
+            self.send('bestmove %s' % (uci_move(pos, move) if move is not None else '0000'))
+
+    def _pv_positions(self, pos, move, depth):
+        """The moves of the principal variation, with the positions they are played from. It
+        has the move to ponder on after the best move, if there is one."""
+        for m in self.searcher.pv(pos, move, max(depth, 2)):
+            yield pos, m
+            pos = pos.move(m)
+
+    def stop(self):
+        """Ends a running search, which then sends its best move."""
+        if self.thread is not None:
+            # Polled by the search, so a stop given once it ended is not left for the next one
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+
+###############################################################################
+# Driving a UCI engine
+###############################################################################
+
+class UCIEngine:
+    """A UCI engine binary run with command (a string or a list of arguments), which answers
+    the requests of ``chess.channel`` the way Sunfish does: ``request()``, ``stats()`` and
+    ``close()`` are those of a ``Channel``. Games start without castling rights, as with
+    Sunfish, and the engine searches each move for movetime milliseconds. options are given
+    to it with ``setoption``."""
+    def __init__(self, command, movetime=UCI_MOVETIME, options=None):
+        if not isinstance(command, (list, tuple)):
+            command = shlex.split(command)
+        self.movetime = movetime
+        self.start_pos = initial_position(castling=False)
+        self.latency = {}
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        self.lines = Queue()
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        self._send('uci')
+        self._expect('uciok', UCI_STARTUP_TIMEOUT)
+        for name, value in (options or {}).items():
+            self._send('setoption name %s value %s' % (name, value))
+        self._send('isready')
+        self._expect('readyok', UCI_STARTUP_TIMEOUT)
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self.lines.put(line.strip())
+
+    def _send(self, line):
+        self.process.stdin.write(line + '\n')
+        self.process.stdin.flush()
+
+    def _expect(self, prefix, timeout=None, skipped=None):
+        """Returns the next line of the engine starting with prefix, skipping the others, which
+        are given to skipped if set."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            left = max(0, deadline - time.time()) if deadline is not None else None
+            try:
+                line = self.lines.get(timeout=left)
+            except Empty:
+                raise ChannelTimeout("No %s from the UCI engine within %s seconds"
+                                     % (prefix, timeout))
+            if line.split()[:1] == [prefix]:
+                return line
+            if skipped is not None:
+                skipped(line)
+
+    def request(self, kind, payload=None, timeout=None, progress=None):
+        """Answers a request like Sunfish would. Returns the payload of the answer. progress is
+        called with the depth, move and score of the ``info`` lines of the engine meanwhile,
+        as with ``chess.channel.INFO``."""
+        start = time.time()
+        if kind == PING:
+            self._send('isready')
+            answer = self._expect('readyok', timeout)
+        elif kind == MOVE:
+            answer = self._move(payload, timeout, progress)
+        else:
+            raise ChannelError("Unknown request: %s" % kind)
+        self.latency.setdefault(kind, LatencyHistogram()).add(time.time() - start)
+        return None if kind == PING else answer
+
+    def _move(self, payload, timeout, progress):
+        moves, command = payload
+        try:
+            if len(moves) % 2:
+                raise ValueError("Not the user's turn after %d moves" % len(moves))
+            pos = sunfish.replay(self.start_pos, moves)
+        except ValueError as e:
+            raise ChannelError(str(e))
+        try:
+            pos = pos.move(parse_move(pos, command))
+        except ValueError:
+            return 0, None, None
+        if not list(pos.legal_moves()):
+            if sunfish.is_check(pos):
+                return 1, None, None
+            raise ChannelError("No move to play")
+
+        self._send('position fen %s moves %s' % (NO_CASTLING_FEN, ' '.join(moves + [command])))
+        self._send('go movetime %d' % self.movetime)
+
+        def info(line):
+            match = re.match(r'info .*?\bdepth (\d+) .*?\bscore (cp|mate) (-?\d+)'
+                             r'.*?\bpv ([a-h][1-8][a-h][1-8])', line)
+            if match and progress is not None:
+                depth, unit, value, move = match.groups()
+                progress((int(depth), move, parse_score(unit, int(value))))
+        try:
+            line = self._expect('bestmove', timeout, info)
+        except ChannelTimeout:
+            # The engine must still answer, or its late move would be taken for the next one
+            self._send('stop')
+            self._expect('bestmove', UCI_STOP_TIMEOUT)
+            raise
+        try:
+            move = parse_move(pos, line.split()[1][:4])
+        except (IndexError, ValueError):
+            raise ChannelError("The UCI engine played an unknown move: %s" % line)
+        reply = pos.move(move)
+        code = 2 if not list(reply.legal_moves()) and sunfish.is_check(reply) else 3
+        # Nothing is known of the search of the engine
+        return code, uci_move(pos, move)[:4], None
+
+    def stats(self):
+        """Latency statistics per request type, see ``chess.channel.LatencyHistogram``."""
+        return dict((kind, histogram.stats()) for kind, histogram in self.latency.items())
+
+    def close(self):
+        self._send('quit')
+        self.process.wait()
+
+
+if __name__ == '__main__':
+    UCI().run()
@@ -2,6 +2,7 @@ from __future__ import print_function
 import sys
 import time
 import argparse
+import threading
 import cv2
 import camera_subscriber
 from perception.mainDetect import Perception
@@ -149,8 +150,21 @@ def main(static):
                 # Now it's the robots turn
                 robot_move = True
 
+                # Once the engine's best move is stable, send the arm towards the piece it
+                # will pick up while the search finishes
+                hovering = []
+
+                def on_progress(progress):
+                    if progress.stable and not hovering:
+                        print("Moving towards", progress.square, "for", progress.move)
+                        hovering.append(threading.Thread(target=planner.hover,
+                                                         args=(arm, progress.square)))
+                        hovering[0].start()
+
                 # Get new move from Chess Engine
-                status, msg = engine.input_bwe(bwe_converted)
+                status, msg = engine.input_bwe(bwe_converted, progress=on_progress)
+                for thread in hovering:
+                    thread.join()
 
                 # Let Chess Engine finish
                 time.sleep(0.05)
@@ -165,7 +179,7 @@ def main(static):
                     sys.exit()
                 print("Executing chess motion...")
                 # msg = [('n', 'h1g3')]  # example of chess move
-                planner.input_chess_move(arm, msg)
+                planner.input_chess_move(arm, msg, hovering=bool(hovering))
 
                 # END of ROBOT turn / B clock stops / A clock starts
                 # clock.sig_q.put(2)
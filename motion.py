@@ -446,13 +446,15 @@ class MotionPlanner:
 
             return coord_start, coord_goal, coord_died
 
-    def generate_moves(self, chess_move_an, franka):
+    def generate_moves(self, chess_move_an, franka, hovering=False):
         """
         Generates a number of segments each a straight line path that will execute the move
         generated by the chess engine.
 
         :param chess_move_an: Takes chess move in algebraic notation from chess engine
         :param franka: Takes franka control object as argument to find current position
+        :param hovering: Whether the arm already hovers above the board (see ``hover``), in
+            which case it doesn't go back to the rest position first.
         :return: a list of lists that depict the full start to goal trajectory of each segment
         """
         if len(chess_move_an) == 1:
@@ -492,6 +494,9 @@ class MotionPlanner:
         else:
             raise ValueError("The length of the chess move was invalid; not 1 or 2 items")
 
+        if hovering:
+            moves[0] = moves[0][1:]  # skip the path to the rest position
+
         # # plot the trajectory
         # if self.visual:
         #     fig = plt.figure()
@@ -527,13 +532,31 @@ class MotionPlanner:
 
         return moves
 
-    def input_chess_move(self, arm_object, chess_move_an):
+    def hover(self, arm_object, square, acceleration=0.02):
+        """
+        Moves the arm to hover above a square, e.g. above the piece the chess engine is likely
+        to move while it is still searching (see ``ChessEngine.input_bwe``).
+
+        :param arm_object: Takes object of Franka arm control class.
+        :param square: Square to hover above in algebraic notation e.g. ``'e7'``.
+        :param acceleration: Acceleration and deceleration of the trapezium velocity profile.
+        """
+        goal = [sum(i) for i in zip(self.H8, self.number_dict[square[1]],
+                                    self.letter_dict[square[0]])]
+        goal[2] = self.hover_height
+        path = np.array([[arm_object.x, arm_object.y, arm_object.z], goal])
+        arm_object.send_trajectory(self.apply_trapezoid_vel(path, acceleration=acceleration))
+
+    def input_chess_move(self, arm_object, chess_move_an, hovering=False):
         """
         After new move is fetched from the game engine, the result is passed to this
         function so that a trajectory may be generated. This is then executed on FRANKA.
 
         :param arm_object: Takes object of Franka arm control class.
         :param chess_move_an: Takes chess move generated from chess engine.
+        :param hovering: Whether the arm was sent to hover above the board while the engine
+            searched. It then moves on to the piece from where it is, whichever square it
+            hovers above.
         """
         ungrip_dim = 0.045
         gripper_delay = 0.5
@@ -550,7 +573,7 @@ class MotionPlanner:
         else:
             a = 0.02
 
-        moves = self.generate_moves(chess_move_an, arm_object)
+        moves = self.generate_moves(chess_move_an, arm_object, hovering)
         current_position = [arm_object.x, arm_object.y, arm_object.z]
 
         for i, series in enumerate(moves):